@@ -0,0 +1,219 @@
+"""Benchmarks the phases of the src/fill-template.py pipeline on synthetic templates.
+
+Each case generates a template along four axes: line count, #if/#ifdef nesting depth,
+number of #defines and the density of @secret:/@env:/@setting.sh: references.  The lexer,
+the direct PreprocessorParser, the Lark parse, the ParsePreprocessor transform, the
+optimizer, the VM with and without it and find_replace_variables are timed separately, the
+best of --repeat runs is kept, and the results are written as JSON.  With --baseline the
+results are compared against an earlier run and any phase that got slower than --threshold
+is reported as a regression (exit status 1).
+
+    python3 bench-fill-template.py --lines 1,1000,100000 --output bench.json
+    python3 bench-fill-template.py --baseline bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+from load_script import load_script
+
+
+ft = load_script("src/fill-template.py")
+
+
+class BenchSecretBackend(ft.SecretBackend):
+    """Answers every secret lookup locally, so secret references cost no network time"""
+    def get_secret(self, secretid):
+        return { "username": f"{secretid.name}-user", "password": f"{secretid.name}-password" }
+
+
+def generate_template(lines : int, depth : int, defines : int, density : float, seed : int=1):
+    """- Generates a synthetic template as a list of lines
+    Args:
+        lines :int: Approximate number of lines
+        depth :int: Nesting depth of the #if/#ifdef blocks wrapping the text
+        defines :int: Number of #define lines at the top
+        density :float: Fraction of text lines carrying a variable reference
+        seed :int: Random seed, the same arguments always give the same template
+    """
+    rnd = random.Random(seed)
+    out = [ f'#define DEF_{n} "value-{n}"\n' for n in range(defines) ]
+    refs = [
+        "@env:BENCHVAR@",
+        "@setting.sh:PROJECT@",
+        "@secret:bench-secret-{n}.password@",
+        "@secret:bench-secret-{n}.username@",
+    ]
+    n = len(out)
+    while n < lines:
+        for d in range(depth):
+            out.append('#if ENV=="dev"\n' if d % 2 == 0 else f"#ifdef DEF_{d % max(defines, 1)}\n")
+        for _ in range(min(16, max(lines - n, 1))):
+            text = f"key.{n}=line {n}"
+            if defines and rnd.random() < 0.5:
+                text += f" DEF_{rnd.randrange(defines)}"
+            if rnd.random() < density:
+                text += " " + rnd.choice(refs).format(n=rnd.randrange(8))
+            out.append(text + "\n")
+            n += 1
+        for d in range(depth):
+            if d % 2 == 1:
+                out.append("#else\n")
+                out.append(f"key.else.{n}=skipped\n")
+            out.append("#endif\n")
+    return out[:max(lines, 1)] if depth == 0 else out
+
+
+def replay_parser():
+    """- Returns a Lark parser fed from a token list, so the parse is timed without the lexer"""
+    from lark import Lark
+    from lark.lexer import Lexer
+
+    class ReplayLexer(Lexer):
+        def __init__(self, lexer_conf=None):
+            pass
+
+        def lex(self, tokens):
+            return iter(tokens)
+
+    return Lark(ft.preprocessor_bnf, parser='lalr', lexer=ReplayLexer)
+
+
+def run_case(lines, depth, defines, density, repeat, reference):
+    """- Times each phase of one case and returns the best time per phase in seconds"""
+    template = generate_template(lines, depth, defines, density)
+    parser = replay_parser()
+    _, transformer = ft.load_lark()
+    best = {}
+
+    def timed(phase, fn):
+        t = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - t
+        best[phase] = min(best.get(phase, elapsed), elapsed)
+        return result
+
+    for _ in range(repeat):
+        ft.secret_cache.values.clear()
+        env = { "ENV": "dev" }
+        if reference:
+            timed("lex_reference", lambda: list(ft.PreprocessorLexer().lex(ft.Fpos(list(template)))))
+        tokens = timed("lex", lambda: list(ft.CompiledPreprocessorLexer().lex(ft.Fpos(list(template)))))
+        timed("parse_direct", lambda: ft.PreprocessorParser(ft.PreprocessorVM()).parse(tokens))
+        tree = timed("parse", lambda: parser.parse(tokens))
+        vm = ft.CompiledPreprocessorVM(dict(env))
+        timed("transform", lambda: vm.prog(transformer(vm).transform(tree)))
+        prog = timed("link", lambda: ft.Program.link(vm.progmem))
+        if reference:
+            timed("execute_compiled", lambda: vm.execute(prog))
+        # run_program runs linked programs on PreprocessorVM
+        runvm = ft.PreprocessorVM(dict(env))
+        runvm.prog(vm.progmem)
+        timed("execute", runvm.execute)
+        body = "".join(runvm.output)
+        optimized = timed("optimize", lambda: ft.optimize(vm.progmem, env))
+        optvm = ft.PreprocessorVM(dict(env))
+        optvm.prog(optimized)
+        timed("execute_optimized", optvm.execute)
+        timed("find_replace_variables", lambda: ft.find_replace_variables(body))
+    return {
+        "case": { "lines": lines, "depth": depth, "defines": defines, "density": density },
+        "template_lines": len(template),
+        "tokens": len(tokens),
+        "instructions": len(prog),
+        "phases": best,
+    }
+
+
+def case_name(case):
+    return ",".join(f"{k}={v}" for k, v in case.items())
+
+
+def compare(results, baseline, threshold, min_delta):
+    """- Compares phase times against a baseline run
+    Returns:
+        :Tuple[dict, list]: the time ratio per case and phase, and the regressions found
+    """
+    base = { case_name(r["case"]): r["phases"] for r in baseline["results"] }
+    ratios = {}
+    regressions = []
+    for r in results:
+        name = case_name(r["case"])
+        if name not in base:
+            continue
+        ratios[name] = {}
+        for phase, t in r["phases"].items():
+            b = base[name].get(phase)
+            if not b:
+                continue
+            ratios[name][phase] = round(t / b, 3)
+            if t > b * (1 + threshold) and t - b > min_delta:
+                regressions.append({ "case": name, "phase": phase, "baseline": b, "time": t })
+    return ratios, regressions
+
+
+def int_list(s):
+    return [ int(x) for x in s.split(",") ]
+
+
+def float_list(s):
+    return [ float(x) for x in s.split(",") ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the fill-template pipeline")
+    parser.add_argument("--lines", type=int_list, default=[1, 100, 10000], help="line counts, up to 1000000")
+    parser.add_argument("--depth", type=int_list, default=[0, 4], help="#if/#ifdef nesting depths")
+    parser.add_argument("--defines", type=int_list, default=[0, 50], help="numbers of #define lines")
+    parser.add_argument("--density", type=float_list, default=[0.1], help="fractions of lines with references")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case, the best is kept")
+    parser.add_argument("--reference", action="store_true", help="also time the reference lexer and the compiled VM")
+    parser.add_argument("--output", help="JSON results file, stdout if not given")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed slowdown per phase")
+    parser.add_argument("--min-delta", type=float, default=0.001, help="ignore slowdowns below this many seconds")
+    args = parser.parse_args()
+
+    os.environ.setdefault("BENCHVAR", "bench")
+    ft.settings = { "PROJECT": "bench-project" }
+    ft.secret_backend = BenchSecretBackend()
+
+    results = []
+    for lines in args.lines:
+        for depth in args.depth:
+            for defines in args.defines:
+                for density in args.density:
+                    r = run_case(lines, depth, defines, density, args.repeat, args.reference)
+                    phases = " ".join(f"{k}={v*1000:.2f}ms" for k, v in r["phases"].items())
+                    print(f"{case_name(r['case'])}: {phases}", file=sys.stderr)
+                    results.append(r)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "results": results,
+    }
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "rt") as f:
+            baseline = json.load(f)
+        report["comparison"], regressions = compare(results, baseline, args.threshold, args.min_delta)
+        report["regressions"] = regressions
+        for r in regressions:
+            print(f"REGRESSION {r['case']} {r['phase']}: {r['baseline']*1000:.2f}ms -> {r['time']*1000:.2f}ms", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "wt") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
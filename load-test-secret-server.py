@@ -0,0 +1,286 @@
+"""Load-tests tiny-secret-server.py against stub keyring and foundrysmith backends.
+
+The server runs in a child process, started from this script with --serve, where the stubs
+stand in for keyring.get_password and foundrysmith.FoundryAPI with a configurable latency and
+error rate.  Client threads then drive a mix of /secret/ and /foundry-token requests at each
+--concurrency level for --duration seconds, and the throughput, p50/p95/p99 latency and error
+rate per level are written as JSON together with the server's cache counters.  Arguments after
+'--' are passed to the server, so server modes and cache settings can be compared run by run.
+
+    python3 load-test-secret-server.py --concurrency 1,4,16,64 --output load.json
+    python3 load-test-secret-server.py --keyring-latency 0.2 -- --workers 64 --secret-ttl 0
+"""
+import argparse
+import base64
+import http.client
+import json
+import os
+import platform
+import random
+import ssl
+import subprocess
+import sys
+import threading
+import time
+import types
+
+from load_script import load_script
+
+
+class StubBackend:
+    """Sleeps for a latency with some jitter, then fails with the given probability"""
+    def __init__(self, name : str, latency : float, jitter : float, errors : float):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = errors
+        self.random = random.Random()
+
+    def call(self):
+        delay = self.latency * (1 + self.jitter * (2 * self.random.random() - 1))
+        time.sleep(max(delay, 0))
+        if self.random.random() < self.errors:
+            raise RuntimeError(f"stub {self.name} error")
+
+
+def install_stubs(args):
+    """- Registers stub keyring and foundrysmith modules, so the server imports them instead"""
+    keyring_backend = StubBackend("keyring", args.keyring_latency, args.jitter, args.keyring_errors)
+    foundry_backend = StubBackend("foundry", args.foundry_latency, args.jitter, args.foundry_errors)
+
+    def get_password(service, user):
+        keyring_backend.call()
+        return json.dumps({ "username": user, "password": f"{service}-{user}-password" })
+
+    class FoundryAPI:
+        def __init__(self):
+            foundry_backend.call()
+            claims = { "sub": "load-test", "exp": int(time.time() + args.token_lifetime) }
+            payload = base64.urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip("=")
+            self.auth_token = f"e30.{payload}.stub"
+
+    keyring = types.ModuleType("keyring")
+    keyring.get_password = get_password
+    foundrysmith = types.ModuleType("foundrysmith")
+    foundrysmith.FoundryAPI = FoundryAPI
+    sys.modules["keyring"] = keyring
+    sys.modules["foundrysmith"] = foundrysmith
+
+
+def serve(args, server_args):
+    """- Runs tiny-secret-server.py with the stub backends, in the child process"""
+    install_stubs(args)
+    server = load_script("tiny-secret-server.py")
+    sys.argv = [ "tiny-secret-server.py" ] + server_args
+    server.main()
+
+
+def start_server(args, server_args):
+    """- Starts the server in a child process and waits until it accepts connections"""
+    stub_args = [ "--keyring-latency", str(args.keyring_latency), "--foundry-latency", str(args.foundry_latency),
+                  "--keyring-errors", str(args.keyring_errors), "--foundry-errors", str(args.foundry_errors),
+                  "--jitter", str(args.jitter), "--token-lifetime", str(args.token_lifetime) ]
+    child = subprocess.Popen([ sys.executable, os.path.abspath(__file__), "--serve" ] + stub_args + [ "--" ] + server_args,
+                             stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        if child.poll() is not None:
+            raise SystemExit(f"server exited with status {child.returncode}")
+        try:
+            conn = connect(args)
+            conn.request("GET", "/metrics")
+            conn.getresponse().read()
+            conn.close()
+            return child
+        except OSError:
+            time.sleep(0.1)
+    child.terminate()
+    raise SystemExit("server did not start")
+
+
+def client_context(args):
+    if not args.tls:
+        return None
+    name = "mtls-client.domain.com"
+    context = ssl.create_default_context(cafile=f"{args.certs}/certs/myCA.pem")
+    context.load_cert_chain(f"{args.certs}/{name}/{name}.crt", f"{args.certs}/{name}/{name}.key")
+    return context
+
+
+class ResumingHTTPSConnection(http.client.HTTPSConnection):
+    """HTTPSConnection offering a TLS session from an earlier connection, so reconnecting
+    clients resume like a real client library would"""
+    session = None
+
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host, session=self.session)
+
+
+def connect(args, context=None, session=None):
+    if args.tls:
+        conn = ResumingHTTPSConnection("localhost", args.port, timeout=30, context=context or client_context(args))
+        conn.session = session
+        return conn
+    return http.client.HTTPConnection("localhost", args.port, timeout=30)
+
+
+def percentile(values, p):
+    """- Returns the nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def summarize(samples, elapsed):
+    """- Returns the throughput, latency percentiles in milliseconds and error rate of samples"""
+    latencies = sorted(t for _, t, ok in samples)
+    errors = sum(1 for _, _, ok in samples if not ok)
+    ms = lambda v: None if v is None else round(v * 1000, 3)
+    return {
+        "requests": len(samples),
+        "throughput": round(len(samples) / elapsed, 1),
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "p50_ms": ms(percentile(latencies, 50)),
+        "p95_ms": ms(percentile(latencies, 95)),
+        "p99_ms": ms(percentile(latencies, 99)),
+        "max_ms": ms(latencies[-1] if latencies else None),
+    }
+
+
+def run_level(args, concurrency):
+    """- Drives the server from 'concurrency' client threads for --duration seconds
+    Returns:
+        :dict: the summary of all requests and of each route
+    """
+    context = client_context(args)
+    deadline = time.monotonic() + args.duration
+    samples = []
+    lock = threading.Lock()
+
+    def client(n):
+        rnd = random.Random(n)
+        conn = None
+        session = None
+        local = []
+        while time.monotonic() < deadline:
+            if rnd.random() < args.token_fraction:
+                route, path = "/foundry-token", "/foundry-token"
+            else:
+                route, path = "/secret", f"/secret/load-test/user-{rnd.randrange(args.keys)}"
+            t = time.perf_counter()
+            try:
+                if conn is None:
+                    conn = connect(args, context, session)
+                conn.request("GET", path)
+                response = conn.getresponse()
+                response.read()
+                ok = response.status == 200
+                # a TLS 1.3 session ticket arrives after the handshake, it is read with the response
+                session = getattr(conn.sock, "session", None) or session
+                if not args.keep_alive or response.will_close:
+                    conn.close()
+                    conn = None
+            except (OSError, http.client.HTTPException):
+                ok = False
+                if conn is not None:
+                    conn.close()
+                conn = None
+            local.append((route, time.perf_counter() - t, ok))
+        if conn is not None:
+            conn.close()
+        with lock:
+            samples.extend(local)
+
+    start = time.perf_counter()
+    threads = [ threading.Thread(target=client, args=(n,)) for n in range(concurrency) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    result = { "concurrency": concurrency, **summarize(samples, elapsed), "routes": {} }
+    for route in ("/secret", "/foundry-token"):
+        result["routes"][route] = summarize([ s for s in samples if s[0] == route ], elapsed)
+    return result
+
+
+def server_metrics(args):
+    """- Returns the cache and TLS counters of the server's /metrics"""
+    conn = connect(args)
+    conn.request("GET", "/metrics")
+    text = conn.getresponse().read().decode()
+    conn.close()
+    found = {}
+    for line in text.splitlines():
+        if line.startswith("secret_server_cache_") or line.startswith("secret_server_tls_"):
+            name, value = line.rsplit(" ", 1)
+            found[name[len("secret_server_"):]] = float(value)
+    return found
+
+
+def int_list(s):
+    return [ int(x) for x in s.split(",") ]
+
+
+def main():
+    argv = sys.argv[1:]
+    server_args = []
+    if "--" in argv:
+        server_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+
+    parser = argparse.ArgumentParser(description="Load-test tiny-secret-server with stub backends")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--concurrency", type=int_list, default=[1, 4, 16], help="client threads per level")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per level")
+    parser.add_argument("--keys", type=int, default=100, help="distinct secrets requested")
+    parser.add_argument("--token-fraction", type=float, default=0.1, help="fraction of /foundry-token requests")
+    parser.add_argument("--no-keep-alive", dest="keep_alive", action="store_false", help="one connection per request")
+    parser.add_argument("--keyring-latency", type=float, default=0.05, help="seconds per keyring lookup")
+    parser.add_argument("--foundry-latency", type=float, default=1.0, help="seconds per FoundryAPI()")
+    parser.add_argument("--keyring-errors", type=float, default=0.0, help="fraction of failing keyring lookups")
+    parser.add_argument("--foundry-errors", type=float, default=0.0, help="fraction of failing FoundryAPI() calls")
+    parser.add_argument("--jitter", type=float, default=0.2, help="backend latency varies by this fraction")
+    parser.add_argument("--token-lifetime", type=float, default=3600, help="seconds until a stub token expires")
+    parser.add_argument("--tls", action="store_true", help="use mTLS with the certificates of make-test-certs.sh")
+    parser.add_argument("--certs", default="./openssl", help="certificate directory for --tls")
+    parser.add_argument("--port", type=int, default=4480)
+    parser.add_argument("--output", help="JSON results file, stdout if not given")
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve(args, server_args)
+        return
+
+    server_args = [ "--port", str(args.port), "--access-log", os.devnull ] + server_args
+    server_args += [ "--certs", args.certs ] if args.tls else [ "--no-tls" ]
+    child = start_server(args, server_args)
+    try:
+        levels = []
+        for concurrency in args.concurrency:
+            r = run_level(args, concurrency)
+            print(f"concurrency={concurrency}: {r['throughput']} req/s p50={r['p50_ms']}ms p95={r['p95_ms']}ms "
+                  f"p99={r['p99_ms']}ms errors={r['error_rate']:.2%}", file=sys.stderr)
+            levels.append(r)
+        report = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "config": { k: v for k, v in vars(args).items() if k not in ("serve", "output") },
+            "server_args": server_args,
+            "levels": levels,
+            "server": server_metrics(args),
+        }
+    finally:
+        child.terminate()
+        child.wait()
+
+    if args.output:
+        with open(args.output, "wt") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
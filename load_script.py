@@ -0,0 +1,20 @@
+"""Imports the scripts of this repository, whose hyphenated file names are not importable by
+name, for the tests, benchmarks and load tests next to this file.
+
+    from load_script import load_script
+    ft = load_script("src/fill-template.py")
+"""
+import importlib.util
+import os
+
+
+def load_script(path : str):
+    """- Imports a script as a module named after its file, fill-template.py as fill_template
+    Args:
+        path :str: The script, relative to the repository root
+    """
+    name = os.path.splitext(os.path.basename(path))[0].replace("-", "_")
+    spec = importlib.util.spec_from_file_location(name, os.path.join(os.path.dirname(os.path.abspath(__file__)), path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
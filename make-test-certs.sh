@@ -0,0 +1,26 @@
+# make-test-certs.sh generates throwaway mTLS certificates for tiny-secret-server.py under ./openssl
+#   openssl/certs/myCA.pem                   CA trusted by both sides, its CN is the server name
+#   openssl/mtls-server.domain.com/*.crt|key server certificate
+#   openssl/mtls-client.domain.com/*.crt|key client certificate
+set -e
+dir=${1:-./openssl}
+days=${DAYS:-30}
+subject="/C=US/ST=Test/L=Test/O=tiny-secret-server"
+
+mkdir -p "$dir/certs"
+openssl req -x509 -newkey rsa:2048 -nodes -days $days -sha256 \
+    -keyout "$dir/certs/myCA.key" -out "$dir/certs/myCA.pem" \
+    -subj "$subject/OU=CA/CN=mtls-server.domain.com" \
+    -addext "basicConstraints=critical,CA:TRUE" -addext "keyUsage=critical,keyCertSign,cRLSign" 2>/dev/null
+
+for name in mtls-server.domain.com mtls-client.domain.com ; do
+    usage=$([ $name = mtls-server.domain.com ] && echo serverAuth || echo clientAuth)
+    mkdir -p "$dir/$name"
+    openssl req -newkey rsa:2048 -nodes -sha256 -keyout "$dir/$name/$name.key" -out "$dir/$name/$name.csr" \
+        -subj "$subject/OU=${usage}/CN=$name" 2>/dev/null
+    printf "subjectAltName=DNS:%s,DNS:localhost,IP:127.0.0.1\nextendedKeyUsage=%s\n" $name $usage >"$dir/$name/$name.ext"
+    openssl x509 -req -in "$dir/$name/$name.csr" -CA "$dir/certs/myCA.pem" -CAkey "$dir/certs/myCA.key" \
+        -CAcreateserial -days $days -sha256 -extfile "$dir/$name/$name.ext" -out "$dir/$name/$name.crt" 2>/dev/null
+    rm -f "$dir/$name/$name.csr" "$dir/$name/$name.ext"
+done
+echo "certificates written to $dir"
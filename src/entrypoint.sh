@@ -3,7 +3,7 @@ stages=${*:-1 2 3}
 
 # start sonarqube server and wait for it to come up
 if grep -q 1 <<<"$stages" ; then
-    python3 /tmp/fill-template.py /tmp/sonarqube_cnf.patch.template
+    python3 /tmp/fill-template.py --run /tmp/sonarqube_cnf.patch.template
     patch -d/ -p0 </tmp/sonarqube_cnf.patch
     bash /opt/sonarqube/bin/linux-x86-64/sonar.sh start
     sleep 5
@@ -17,7 +17,7 @@ if grep -q 2 <<<"$stages" ; then
     bash /opt/sonarscan.sh setup
 fi
 
-# setup scanner and run scans
+# clone and scan the repositories in parallel, stopping before the next daily CronJob run
 if grep -q 3 <<<"$stages" ; then
-    bash /opt/sonarscan.sh repository_list       
+    python3 /opt/scan-scheduler.py --window ${SCAN_WINDOW:-82800} repository_list
 fi
@@ -5,12 +5,22 @@ import sys
 import os
 import re
 import json
-from lark import Lark, Transformer
-from lark.lexer import Lexer, Token
+import glob
+import hashlib
+import shlex
+import stat
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import marshal
+import contextlib
+import itertools
+import tracemalloc
+import operator
 from io import StringIO, IOBase
 import sys
 import re
 from typing import List, Union
+from array import array
 import sys
 
 class ErrorReport:
@@ -40,6 +50,18 @@ class KnownSecret:
     def get_secret(self, id):
         return { "name": id.name, "sonartoken": f"!!!sonartoken-{id.name}!!!" }
 
+class Token(str):
+    """Stand-in for lark's Token, so the lexers work without lark.  load_lark() replaces it
+    with lark's Token once the parser is needed"""
+    def __new__(cls, type, value, start_pos=None, line=None, column=None):
+        token = super().__new__(cls, value)
+        token.type = type
+        token.value = value
+        token.start_pos = start_pos
+        token.line = line
+        token.column = column
+        return token
+
 class Arglist:
     def __init__(self, args):
         self.args = args
@@ -49,41 +71,161 @@ class Arglist:
         self.args = self.args[1:]
         return arg
 
+    def __len__(self):
+        return len(self.args)
+
 errors = ErrorReport()
 
+
+class Profile:
+    """Wall time, allocation peak and call count per pipeline phase, plus event counters.
+    Only created with --profile, everything else checks the global 'profile' for None"""
+    def __init__(self):
+        self.phases = {}
+        self.counters = {}
+        self.stack = []
+        tracemalloc.start()
+
+    @contextlib.contextmanager
+    def phase(self, name : str):
+        """- Times a phase, phases may nest"""
+        current, peak = tracemalloc.get_traced_memory()
+        if self.stack:
+            self.stack[-1][1] = max(self.stack[-1][1], peak)
+        tracemalloc.reset_peak()
+        frame = [current, current]
+        self.stack.append(frame)
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t
+            self.stack.pop()
+            peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+            if self.stack:
+                self.stack[-1][1] = max(self.stack[-1][1], peak)
+            p = self.phases.setdefault(name, { "calls": 0, "seconds": 0.0, "peak_bytes": 0 })
+            p["calls"] += 1
+            p["seconds"] += elapsed
+            p["peak_bytes"] = max(p["peak_bytes"], peak - frame[0])
+
+    def count(self, name : str, n : int=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, data : dict):
+        """- Adds the data of another profile, see as_dict"""
+        for name, q in data["phases"].items():
+            p = self.phases.setdefault(name, { "calls": 0, "seconds": 0.0, "peak_bytes": 0 })
+            p["calls"] += q["calls"]
+            p["seconds"] += q["seconds"]
+            p["peak_bytes"] = max(p["peak_bytes"], q["peak_bytes"])
+        for name, n in data["counters"].items():
+            self.count(name, n)
+
+    def as_dict(self) -> dict:
+        return { "phases": self.phases, "counters": self.counters }
+
+    def report(self, f):
+        """- Writes a readable summary to 'f'"""
+        print("phase                     calls    seconds    peak KiB", file=f)
+        for name, p in self.phases.items():
+            print(f"{name:<24} {p['calls']:>6} {p['seconds']:>10.4f} {p['peak_bytes']/1024:>11.1f}", file=f)
+        for name, n in sorted(self.counters.items()):
+            print(f"{name:<24} {n:>6}", file=f)
+
+
+profile = None
+def phase(name : str):
+    """- Context manager timing a pipeline phase when profiling, a no-op otherwise"""
+    return profile.phase(name) if profile else contextlib.nullcontext()
+
 def usage():
     """- Shows usage information for fill-template.py"""
-    print("Usage: fill-template.py [-D <VARNAME>=<value>] <templatefile>")
+    print("Usage: fill-template.py [-D <VARNAME>=<value>] [-I <includedir>] [--stream] [--force] [--compile|--run]")
+    print("           [-j <jobs>] [--glob <pattern>] [--secrets <secrets.json>] [--secret-ttl <seconds>]")
+    print("           [--profile|--profile-json <file>] [--lark] [--matrix <environments.json>]")
+    print("           <templatefile|directory>...")
+    print("       fill-template.py [options] [--daemon <socket>] [--watch] [--interval <seconds>] [<templatefile|directory>...]")
     sys.exit(1)
 
 
-def replace_variable(body, span, varvalue):
-    """- Global string replacement in the body of a document
-    Args:
-        body :str: The document being changed
-        span :str: The text that was detected as replaceable
-        varvalue :str: Replacement for the span
-    """
-    #print(f"replace_variable(body..., {span}, {varvalue})")
-    if varvalue is None:
-        varvalue = "NODATA"
-    body = body.replace(span, varvalue)
-    #print(body)
-    return body
+class SecretBackend:
+    """Source of secret values, looked up by SecretId.  Backends must be safe to call from
+    several threads at once"""
+    def get_secret(self, secretid : SecretId) -> dict:
+        """- Returns the properties of a secret, or None if it is unknown"""
+        raise NotImplementedError()
+
+    def get_version(self, secretid : SecretId) -> str:
+        """- Returns a version identifier of a secret, or None to compare the secret by value"""
+        return None
+
+
+class KnownSecretBackend(SecretBackend):
+    """Looks up secrets through KnownSecret, from keyring or AWS SecretsManager"""
+    def get_secret(self, secretid : SecretId) -> dict:
+        return KnownSecret().get_secret(secretid)
+
+
+class FileSecretBackend(SecretBackend):
+    """Reads secrets from a local JSON file of the form { "<name>": { "<property>": "<value>" } },
+    to render templates offline"""
+    def __init__(self, path : str):
+        self.path = path
+        self.load()
+
+    def load(self):
+        """- Reads the secrets file again"""
+        with open(self.path, "rt") as f:
+            self.secrets = json.load(f)
+
+    def get_secret(self, secretid : SecretId) -> dict:
+        return self.secrets.get(secretid.name)
+
+
+class SecretCache:
+    """Secret values by name with a time to live.  A ttl of None keeps values for the whole
+    batch, a ttl of 0 keeps them only while one template is rendered"""
+    def __init__(self, ttl : float=None):
+        self.ttl = ttl
+        self.values = {}
+
+    def begin_document(self):
+        """- Called before each template is rendered"""
+        if self.ttl == 0:
+            self.values.clear()
+
+    def get(self, name : str):
+        """- Returns a cached secret, or None if it is missing or expired"""
+        entry = self.values.get(name)
+        if entry is None:
+            return None
+        expires, value = entry
+        if self.ttl and time.monotonic() >= expires:
+            del self.values[name]
+            return None
+        return value
 
-def get_secret(varname : str) -> str:
-    """- Fetches a well known secret value from its SecretId
+    def put(self, name : str, value):
+        """- Stores a secret"""
+        self.values[name] = (time.monotonic() + (self.ttl or 0), value)
+
+
+secret_backend = KnownSecretBackend()
+secret_cache = SecretCache(ttl=900)
+def fetch_secret(varname : str) -> str:
+    """- Fetches a well known secret value from the secret backend, bypassing the cache
     Args:
         varname :str: The name of the secret, which must match a known SecretId value
     Returns:
         :str: the value of the secret
     """
-
-    secrets = KnownSecret()
+    if profile:
+        profile.count("secret_lookups")
     varvalue = None
     try:
         secretid = SecretId.by_value(varname)
-        varvalue = secrets.get_secret(secretid)
+        varvalue = secret_backend.get_secret(secretid)
         if varvalue is None:
             raise ValueError(f"invalid secret {varname}")
     except AttributeError:
@@ -93,6 +235,52 @@ def get_secret(varname : str) -> str:
     return varvalue
 
 
+def get_secret(varname : str) -> str:
+    """- Fetches a well known secret value from its SecretId, through the secret cache
+    Args:
+        varname :str: The name of the secret, which must match a known SecretId value
+    Returns:
+        :str: the value of the secret
+    """
+    varvalue = secret_cache.get(varname)
+    if profile:
+        profile.count("secret_cache_hits" if varvalue is not None else "secret_cache_misses")
+    if varvalue is None:
+        varvalue = fetch_secret(varname)
+        if varvalue is not None:
+            secret_cache.put(varname, varvalue)
+    return varvalue
+
+
+def prefetch_secrets(body : str, max_workers : int=8):
+    """- Fetches every secret referenced in a document concurrently and caches it
+    References are deduplicated by secret name, so '@secret:x.username@' and
+    '@secret:x.password@' cost one lookup.  Failed lookups are left out of the cache and
+    reported when the reference is interpolated.
+    Args:
+        body :str: The document to scan for '@secret:<name>.<property>@' references
+        max_workers :int: Maximum number of concurrent lookups
+    """
+    names = set()
+    for m in variable_pattern.finditer(body):
+        if m.group(1) == "secret":
+            names.add(m.group(2).split(".")[0])
+    names = [ name for name in sorted(names) if secret_cache.get(name) is None ]
+    if len(names) < 2:
+        return
+
+    def fetch(name):
+        try:
+            return fetch_secret(name)
+        except Exception:
+            return None
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(names))) as pool:
+        for name, varvalue in zip(names, pool.map(fetch, names)):
+            if varvalue is not None:
+                secret_cache.put(name, varvalue)
+
+
 settings = None
 def get_setting(varname : str) -> str:
     """- Returns an entry from a shell script 'setting.sh' in your local directory
@@ -107,6 +295,8 @@ def get_setting(varname : str) -> str:
         :str: the value of the shell variable (ie the dequoted string)
     """
     global settings
+    if profile:
+        profile.count("setting_lookups")
     if settings is None:
         with open("setting.sh", "rt") as f:
             settings = {}
@@ -120,7 +310,35 @@ def get_setting(varname : str) -> str:
     return settings[varname]
 
 
-def find_replace_variables(body : str) -> str:
+variable_pattern = re.compile(r"@([a-zA-Z_\.-]+):([a-zA-Z_\.-]+)@")
+
+def resolve_variable(vartype : str, varname : str) -> str:
+    """- Looks up the value of a single '@<type>:<varname>@' reference
+    Args:
+        vartype :str: The variable type, one of 'secret', 'env' or 'setting.sh'
+        varname :str: The variable name, including the '.<property>' part for secrets
+    Returns:
+        :str: the value of the variable, or "NODATA" if it could not be found
+    """
+    #print(f"resolve_variable: {vartype} {varname}")
+    if vartype == "secret":
+        varname, varprop = varname.split(".")
+        varvalue = get_secret(varname)[varprop]
+    elif vartype == "env":
+        varvalue = os.environ.get(varname)
+        if varvalue is None:
+            errors.error(f"Value error: Unable to get env '{varname}'")
+    elif vartype == "setting.sh":
+        varvalue = get_setting(varname)
+    else:
+        errors.error(f"Unknown variable type: '{vartype}'")
+        varvalue = None
+    if varvalue is None:
+        varvalue = "NODATA"
+    return varvalue
+
+
+def find_replace_variables(body : str, resolved : dict=None, prefetch : bool=True) -> str:
     """- Interpolates variables in the body of a document
 
     Variables have the form '@<type>:<varname>[.<property>]@'.  The supported
@@ -132,32 +350,60 @@ def find_replace_variables(body : str) -> str:
     The <varname> part must match a well-known SecretID value to use the 'secret' type.   For
     other types the <varname> will match the shell variable name.
 
+    The document is scanned once, each distinct variable is resolved only once and the
+    result is assembled with a single join.  Substituted values are not scanned again.
+
     Args:
         body :str: The document body to be interpolated.
+        resolved :dict: Memo table of resolved variables by reference, to share it across calls
+        prefetch :bool: Fetch all secrets of the document concurrently before interpolating
+    """
+    if resolved is None:
+        resolved = {}
+    if prefetch:
+        with phase("prefetch_secrets"):
+            prefetch_secrets(body)
+    parts = []
+    pos = 0
+    for m in variable_pattern.finditer(body):
+        span = m.group(0)
+        varvalue = resolved.get(span)
+        if varvalue is None:
+            varvalue = resolve_variable(m.group(1), m.group(2))
+            resolved[span] = varvalue
+        parts.append(body[pos:m.start()])
+        parts.append(varvalue)
+        pos = m.end()
+    if profile:
+        profile.count("substitutions", len(parts) // 2)
+    if pos == 0:
+        return body
+    parts.append(body[pos:])
+    return "".join(parts)
+
+
+STREAM_PREFETCH_LINES = 256
+def find_replace_variables_stream(lines, resolved : dict=None, batch : int=STREAM_PREFETCH_LINES):
+    """- Interpolates variables line by line, see find_replace_variables
+    Variable references never span a newline, so this gives the same result as interpolating
+    the joined document.  The secrets of each 'batch' lines are prefetched together before
+    they are interpolated, so memory stays bounded by the batch.
+    Args:
+        lines :Iterable[str]: The document lines to be interpolated
+        resolved :dict: Memo table of resolved variables by reference
+        batch :int: Number of lines whose secrets are fetched concurrently
     """
+    if resolved is None:
+        resolved = {}
+    lines = iter(lines)
     while True:
-        m = re.search(r"@([a-zA-Z_\.-]+):([a-zA-Z_\.-]+)@", body)
-        if m:
-            span = m.group(0)
-            vartype = m.group(1)
-            varname = m.group(2)
-            #print(f"find_replace_variables: {vartype} {varname}")
-            if vartype == "secret":
-                varname, varprop = varname.split(".")
-                varvalue = get_secret(varname)[varprop]
-            elif vartype == "env":
-                varvalue = os.environ.get(varname)
-                if varvalue is None:
-                    errors.error(f"Value error: Unable to get env '{varname}'")
-            elif vartype == "setting.sh":
-                varvalue = get_setting(varname)
-            else:
-                errors.error(f"Unknown variable type: '{vartype}'")
-                varvalue = None
-            body = replace_variable(body, span, varvalue)
-        else:
-            break
-    return body
+        chunk = list(itertools.islice(lines, batch))
+        if not chunk:
+            return
+        with phase("prefetch_secrets"):
+            prefetch_secrets("".join(chunk))
+        for line in chunk:
+            yield find_replace_variables(line, resolved, prefetch=False)
 
 class Fpos:
     """Windowed view of an input stream"""
@@ -166,6 +412,7 @@ class Fpos:
         Args:
         data :Union[str, IOBase, List[str]]: A file path or derivative class of IOBase to read from, or a list of lines
         """
+        self.path = data if type(data) is str else None
         if type(data) is str:
             with open(data, "rt") as f:
                 lines = f.readlines()
@@ -185,6 +432,11 @@ class Fpos:
         #print(self.rpos,self.cpos,self.lines[self.rpos][self.cpos:])
         return self.lines[self.rpos][self.cpos:]
 
+    @property
+    def line(self):
+        """- Returns the whole current row without copying it, use with 'cpos' as the offset"""
+        return self.lines[self.rpos]
+
     @property
     def eof(self):
         """- Returns true if the row is past the end of the stream"""
@@ -204,10 +456,57 @@ class Fpos:
             self.cpos = 0
             self.rpos += 1
 
-class PreprocessorLexer(Lexer):
+class StreamingFpos(Fpos):
+    """Windowed view of an input stream that reads one line at a time, so only the current
+    line is held in memory"""
+    def __init__(self, data : Union[str, IOBase]):
+        """ - Provides a windowed view of an input stream, reading it lazily
+        Args:
+        data :Union[str, IOBase]: A file path or derivative class of IOBase to read from
+        """
+        self.path = data if type(data) is str else None
+        if type(data) is str:
+            self.f = open(data, "rt")
+        elif isinstance(data, IOBase):
+            self.f = data
+        else:
+            raise ValueError("Invalid data")
+        self.cpos = 0
+        self.rpos = 0
+        self.current = self.f.readline()
+
+    @property
+    def v(self):
+        """- Returns the current row and column view of the stream"""
+        return self.current[self.cpos:]
+
+    @property
+    def line(self):
+        """- Returns the whole current row without copying it, use with 'cpos' as the offset"""
+        return self.current
+
+    @property
+    def eof(self):
+        """- Returns true if the row is past the end of the stream"""
+        return self.current == ""
+
+    def skip(self, n):
+        """- Moves the cursor forward, reading the next row at the end of line
+        Args:
+            n :int: count of characters to move forward
+        """
+        self.cpos += n
+        if self.cpos >= len(self.current):
+            self.cpos = 0
+            self.rpos += 1
+            self.current = self.f.readline()
+            if self.current == "":
+                self.f.close()
+
+class PreprocessorLexer:
     """Tokenizes an input file returning TEXT tokens for unrecognized text, and preprocessor
     tokens for C preprocessor instructions.  Whitespace is ignored by the lexical analyzer except
-    that it resets the state to rules0"""
+    that it resets the state to rules0.  load_lark() combines it with lark's Lexer"""
     rules0 = {
         "INCLUDE": r"^#[ ]*include",
         "DEFINE": r"^#[ ]*define",
@@ -276,7 +575,57 @@ class PreprocessorLexer(Lexer):
             #print("lex",tok)
 
 
+class CompiledPreprocessorLexer(PreprocessorLexer):
+    """Single pass variant of PreprocessorLexer.  The rules of each state are compiled once into
+    an anchored alternation of named groups, ordered by rule priority, and matched at the cursor
+    offset so the rest of the line is never copied.  The token stream is identical to
+    PreprocessorLexer, including '#ifdef' winning over '#if' by priority"""
+
+    @staticmethod
+    def compile_rules(rules, priority):
+        """- Compiles a rule table into one alternation and a group name to token type map
+        Args:
+            rules :Dict[str, str]: Token type to regular expression
+            priority :List[str]: Token types in the order they are tried
+        """
+        groups = {}
+        alternatives = []
+        for n, r in enumerate(priority):
+            group = f"R{n}"
+            groups[group] = r
+            alternatives.append(f"(?P<{group}>{rules[r]})")
+        return re.compile("|".join(alternatives)), groups
+
+    def __init__(self, lexer_conf=None):
+        """- Construct CompiledPreprocessorLexer"""
+        cls = CompiledPreprocessorLexer
+        if not hasattr(cls, "pattern0"):
+            cls.pattern0, cls.groups0 = cls.compile_rules(self.rules0, self.rules0priority)
+            cls.pattern1, cls.groups1 = cls.compile_rules(self.rules1, self.rules1priority)
+
+    def next_token(self, fp):
+        """- Fetch the next token"""
+        if fp.eof: return None
+        line = fp.line
+        cpos = fp.cpos
+        if cpos == 0:
+            m = self.pattern0.match(line)
+            if m:
+                token = Token(self.groups0[m.lastgroup], m.group(), 0, fp.rpos, cpos)
+            else:
+                token = Token("TEXT", line, 0, fp.rpos, cpos)
+        else:
+            m = self.pattern1.match(line, cpos)
+            if not m:
+                raise TypeError(f"Invalid token at {line[cpos:]}")
+            token = Token(self.groups1[m.lastgroup], m.group(), 0, fp.rpos, cpos)
+        fp.skip(len(token.value))
+        return token
+
+
 class Instruction:
+    __slots__ = ('op',)
+
     def __init__(self, opcode, arg1=None, arg2=None):
         self.op = [opcode, arg1, arg2]
 
@@ -305,28 +654,324 @@ class Instruction:
     def arg2(self):
         return self.op[2]
 
+
+OPCODES = [
+    'HALT', 'EMIT', 'GET', 'CONST', 'EVAL2', 'EVAL1', 'JMPIF', 'JMP', 'SET', 'INCLUDE', 'EXISTS', 'LABEL', 'FATAL',
+    'WRITE'
+]
+OPCODE = { name: n for n, name in enumerate(OPCODES) }
+JUMPS = ( OPCODE['JMP'], OPCODE['JMPIF'] )
+
+
+class Program:
+    """Compact linked form of an instruction list.  Opcodes are small integers in an array,
+    operands are indexes into a shared constant pool held in two parallel arrays (-1 for
+    no operand), and jump operands are absolute offsets.  LABEL pseudo-instructions are
+    removed by the linking pass.  'includes' lists the (path, SHA-256) of each file included
+    into the program"""
+    __slots__ = ('code', 'arg1', 'arg2', 'consts', 'entry', 'includes')
+
+    ARTIFACT_VERSION = 2
+
+    def __init__(self):
+        self.code = array('B')
+        self.arg1 = array('i')
+        self.arg2 = array('i')
+        self.consts = []
+        self.entry = 0
+        self.includes = []
+
+    @classmethod
+    def artifact_header(cls, digest : str):
+        """- Returns the header identifying the artifact format, Python build and template"""
+        return ("fill-template", cls.ARTIFACT_VERSION, tuple(sys.version_info[:2]), sys.byteorder, digest)
+
+    def save(self, path : str, digest : str):
+        """- Writes the program to a compact artifact with marshal
+        Args:
+            path :str: The artifact file
+            digest :str: SHA-256 of the template the program was compiled from
+        """
+        data = (
+            self.artifact_header(digest), self.entry,
+            self.code.tobytes(), self.arg1.tobytes(), self.arg2.tobytes(), tuple(self.consts),
+            tuple(self.includes)
+        )
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            marshal.dump(data, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path : str, digest : str) -> 'Program':
+        """- Reads a program artifact, raising ValueError if it is stale
+        Args:
+            path :str: The artifact file
+            digest :str: SHA-256 of the current template
+        """
+        with open(path, "rb") as f:
+            header, entry, code, arg1, arg2, consts, includes = marshal.load(f)
+        if header != cls.artifact_header(digest):
+            raise ValueError(f"stale program {path}")
+        prog = cls()
+        prog.entry = entry
+        prog.code.frombytes(code)
+        prog.arg1.frombytes(arg1)
+        prog.arg2.frombytes(arg2)
+        prog.consts = list(consts)
+        prog.includes = [ tuple(x) for x in includes ]
+        return prog
+
+    @classmethod
+    def link(cls, instructions : List[Instruction], entry : str='main') -> 'Program':
+        """- Links an instruction list, resolving labels to offsets in one pass over the labels
+        Args:
+            instructions :List[Instruction]: The program to link
+            entry :str: The label execution starts at
+        """
+        labels = {}
+        offset = 0
+        for i in instructions:
+            if i.opcode == 'LABEL':
+                labels[i.arg1] = offset
+            else:
+                offset += 1
+
+        prog = cls()
+        pool = {}
+        def const(v):
+            if v is None:
+                return -1
+            key = (type(v), v)
+            n = pool.get(key)
+            if n is None:
+                n = pool[key] = len(prog.consts)
+                prog.consts.append(v)
+            return n
+
+        for i in instructions:
+            opcode = OPCODE[i.opcode]
+            if opcode == OPCODE['LABEL']:
+                continue
+            prog.code.append(opcode)
+            if opcode in JUMPS:
+                prog.arg1.append(labels[i.arg1])
+            else:
+                prog.arg1.append(const(i.arg1))
+            prog.arg2.append(const(i.arg2))
+        prog.entry = labels[entry]
+        return prog
+
+    def __len__(self):
+        return len(self.code)
+
+    def operand(self, n : int):
+        """- Returns a constant from the pool, None for -1"""
+        return None if n < 0 else self.consts[n]
+
+    def instruction(self, pc : int):
+        """- Returns the decoded (opcode, arg1, arg2) at 'pc', jump operands stay offsets"""
+        opcode = self.code[pc]
+        arg1 = self.arg1[pc] if opcode in JUMPS else self.operand(self.arg1[pc])
+        return OPCODES[opcode], arg1, self.operand(self.arg2[pc])
+
+    def instructions(self) -> List[Instruction]:
+        """- Returns the program as an instruction list again, with a LABEL at each jump target"""
+        jmp, jmpif = JUMPS
+        consts = self.consts
+        targets = { a for c, a in zip(self.code, self.arg1) if c == jmp or c == jmpif }
+        result = []
+        append = result.append
+        for pc, (opcode, arg1, arg2) in enumerate(zip(self.code, self.arg1, self.arg2)):
+            if pc == self.entry:
+                append(Instruction('LABEL', 'main'))
+            if pc in targets:
+                append(Instruction('LABEL', f"L{pc:04d}"))
+            if opcode == jmp or opcode == jmpif:
+                arg1 = f"L{arg1:04d}"
+            else:
+                arg1 = None if arg1 < 0 else consts[arg1]
+            append(Instruction(OPCODES[opcode], arg1, None if arg2 < 0 else consts[arg2]))
+        return result
+
+    def disassemble(self) -> str:
+        """- Returns a listing of the program with jump targets marked"""
+        targets = { self.arg1[pc] for pc in range(len(self)) if self.code[pc] in JUMPS }
+        lines = []
+        for pc in range(len(self)):
+            opcode, arg1, arg2 = self.instruction(pc)
+            mark = ">" if pc in targets else " "
+            if pc == self.entry:
+                mark = "*"
+            args = [ f"@{arg1:04d}" if self.code[pc] in JUMPS else repr(arg1) ] if arg1 is not None else []
+            if arg2 is not None:
+                args.append(repr(arg2))
+            lines.append(f"{mark}{pc:04d} {opcode:<8} {', '.join(args)}".rstrip())
+        return "\n".join(lines)
+
+def define_text(value):
+    """- Returns the text a define is substituted with, or None for flag defines
+    A bare '#define X' stores True, which only marks X as defined and is never substituted
+    into the output.  Other non-string values are substituted with str(value).
+    Args:
+        value :Any: The value of the define
+    """
+    if isinstance(value, bool) or value is None:
+        return None
+    return str(value)
+
+
+def text_overlaps(a : str, b : str) -> bool:
+    """- True if one string contains the other or they overlap end to start
+    Args:
+        a :str: first string
+        b :str: second string
+    """
+    if not a or not b:
+        return True
+    if a in b or b in a:
+        return True
+    for n in range(1, min(len(a), len(b))):
+        if a.endswith(b[:n]) or b.endswith(a[:n]):
+            return True
+    return False
+
+
+def name_overlaps(earlier : str, later : str) -> list:
+    """- Returns the strings in which 'later' starts before an occurrence of 'earlier' and
+    overlaps it, where a single scan would substitute 'later' but one str.replace per define
+    substitutes 'earlier'
+    Args:
+        earlier :str: The define name defined first
+        later :str: The define name defined after it
+    """
+    if later.find(earlier, 1) >= 0:
+        return [ later ]
+    return [ later + earlier[n:] for n in range(1, min(len(earlier), len(later))) if later.endswith(earlier[:n]) ]
+
+
+class DefineIndex:
+    """Substitution index over the define table of the preprocessor.
+
+    The reference semantics are one str.replace per define in definition order.  A single
+    scan with an alternation of the names in definition order gives the same result, unless
+    a name overlaps the start of a name defined before it, or a name can match across the
+    value of a define before it.  Those overlaps are kept as guards: the names overlapping
+    each other, or the define whose value a later name overlaps.  Text containing a guard
+    falls back to the sequential replacements, any other text takes the single scan.  The
+    index is patched when a define is added and rebuilt when one is redefined; the patterns
+    are compiled lazily."""
+    def __init__(self, env : dict):
+        """- Build the index from the current define table
+        Args:
+            env :dict: define name to value, in definition order
+        """
+        self.rebuild(env)
+
+    def rebuild(self, env : dict):
+        """- Recomputes the index from scratch
+        Args:
+            env :dict: define name to value, in definition order
+        """
+        self.table = {}
+        self.guards = set()
+        self.pattern = None
+        self.guard = None
+        for name, value in env.items():
+            self.add(name, define_text(value))
+
+    def add(self, name : str, text : str):
+        """- Appends a new define to the index
+        Args:
+            name :str: The define name
+            text :str: The substitution text, None for flag defines
+        """
+        if text is not None:
+            for other, othertext in self.table.items():
+                if othertext is None:
+                    continue
+                if text_overlaps(name, othertext):
+                    self.guards.add(other)
+                self.guards.update(name_overlaps(other, name))
+        self.table[name] = text
+        self.pattern = None
+        self.guard = None
+
+    def set(self, name : str, value, env : dict):
+        """- Updates the index after a define changed
+        Args:
+            name :str: The define name
+            value :Any: The new value of the define
+            env :dict: The updated define table
+        """
+        if name in self.table:
+            self.rebuild(env)
+        else:
+            self.add(name, define_text(value))
+
+    def compile(self):
+        """- Compiles the alternation of the names and the guards"""
+        names = [ re.escape(name) for name, text in self.table.items() if text is not None ]
+        self.pattern = re.compile("|".join(names)) if names else False
+        self.guard = re.compile("|".join(map(re.escape, sorted(self.guards)))) if self.guards else False
+
+    def sequential(self, body : str) -> bool:
+        """- True if 'body' contains a guard, so its defines are replaced one at a time
+        Args:
+            body :str: The text to substitute
+        """
+        if self.pattern is None:
+            self.compile()
+        return bool(self.guard) and self.guard.search(body) is not None
+
+    def replace_each(self, body : str) -> str:
+        """- Substitutes the defines with one str.replace each, in definition order
+        Args:
+            body :str: The text to substitute
+        """
+        for name, text in self.table.items():
+            if text is not None:
+                body = body.replace(name, text)
+        return body
+
+    def interpolate(self, body : str) -> str:
+        """- Substitutes all defines in a line of text
+        Args:
+            body :str: The text to substitute
+        """
+        if self.sequential(body):
+            return self.replace_each(body)
+        if not self.pattern:
+            return body
+        table = self.table
+        return self.pattern.sub(lambda m: table[m.group()], body)
+
+
 class PreprocessorVM:
     def __init__(self, env=None):
         if env is None:
             env = {}
         self.stack = []
         self.vars = env
+        self.defines = DefineIndex(env)
         self.progmem = [ Instruction('LABEL', 'main') ]
         self.pc = 0
         self.seg_count = 0
         self.output = []
+        self.includes = []
         self.running = False
+        self.steps = 0
         self.labels = {}
         self.scan_labels()
 
     def scan_labels(self):
+        self.labels = {}
         for pc,i in enumerate(self.progmem):
             if i.opcode == 'LABEL':
                 self.labels[i.arg1] = pc
 
     def prog(self, instr):
         self.progmem.extend(instr)
-        self.scan_labels()
 
     def gensym(self):
         self.seg_count += 1
@@ -341,9 +986,7 @@ class PreprocessorVM:
         return v
 
     def interpolate(self, body):
-        for v in self.vars:
-            body = body.replace(v, self.vars[v])
-        return body
+        return self.defines.interpolate(body)
 
     def execute1(self):
         if not self.running: return
@@ -355,8 +998,11 @@ class PreprocessorVM:
         arg2 = instr.arg2
         pc += 1
         self.pc = pc
+        self.steps += 1
         if opcode == 'EMIT':
             self.output.append(self.interpolate(arg1))
+        elif opcode == 'WRITE':
+            self.output.append(arg1)
         elif opcode == 'GET':
             self.push(self.vars[arg1])
         elif opcode == 'CONST':
@@ -388,7 +1034,7 @@ class PreprocessorVM:
             self.push(v)
         elif opcode == 'JMPIF':
             cond = self.pop()
-            sym = arg1
+            lbl = arg1
             if cond:
                 self.pc = self.labels[lbl]
         elif opcode == 'JMP':
@@ -398,6 +1044,7 @@ class PreprocessorVM:
             var = arg1
             val = self.pop()
             self.vars[var] = val
+            self.defines.set(var, val, self.vars)
         elif opcode == 'INCLUDE':
             raise NotImplementedError("Not implemented INCLUDE")
         elif opcode == 'HALT':
@@ -414,6 +1061,7 @@ class PreprocessorVM:
             sys.exit(1)
 
     def execute(self):
+        self.scan_labels()
         self.pc = self.labels['main']
         self.running = True
         while (self.running):
@@ -423,6 +1071,513 @@ class PreprocessorVM:
                 print(self.pc, str(e))
                 raise e
 
+    def stream(self):
+        """- Executes the program, yielding each output line as soon as it is emitted"""
+        self.scan_labels()
+        self.pc = self.labels['main']
+        self.running = True
+        output = self.output
+        while (self.running):
+            try:
+                self.execute1()
+            except Exception as e:
+                print(self.pc, str(e))
+                raise e
+            if output:
+                yield from output
+                output.clear()
+
+    def run_stream(self, chunks):
+        """- Executes a program while it is parsed, yielding each output line as soon as it is emitted
+        The parser only jumps forward, so a taken jump skips the instructions arriving until
+        its label, and no instruction is kept once it was executed or skipped.
+        Args:
+            chunks :Iterable[List[Instruction]]: The instructions, see PreprocessorParser.stream
+        """
+        self.running = True
+        output = self.output
+        skip = None
+        for chunk in chunks:
+            self.progmem = chunk
+            self.pc = 0
+            while self.running and self.pc < len(chunk):
+                instr = chunk[self.pc]
+                try:
+                    if skip is not None:
+                        if instr.opcode == 'LABEL' and instr.arg1 == skip:
+                            skip = None
+                        self.pc += 1
+                    elif instr.opcode == 'JMP' or (instr.opcode == 'JMPIF' and self.pop()):
+                        skip = instr.arg1
+                        self.pc += 1
+                    elif instr.opcode == 'JMPIF':
+                        self.pc += 1
+                    else:
+                        self.execute1()
+                except Exception as e:
+                    print(self.pc, str(e))
+                    raise e
+            if output:
+                yield from output
+                output.clear()
+            if not self.running:
+                break
+
+
+class CompiledPreprocessorVM(PreprocessorVM):
+    """Executes the same programs as PreprocessorVM, which stays the reference implementation,
+    by compiling them first.  The program is linked into a Program and split into basic blocks
+    at jump targets and after jumps.  Each instruction of a block becomes a closure with its
+    operands bound, a run of EMITs becomes a single closure, and the jump ending the block
+    becomes a closure returning the index of the next block, resolved ahead of time, or -1 on
+    HALT."""
+    EVAL2 = {
+        '==': operator.eq, '<=': operator.le, '>=': operator.ge,
+        '<': operator.lt, '>': operator.gt, '!=': operator.ne,
+    }
+    ENDS = ( OPCODE['JMP'], OPCODE['JMPIF'], OPCODE['HALT'], OPCODE['FATAL'] )
+
+    @classmethod
+    def blocks(cls, prog : Program) -> List[int]:
+        """- Returns the start offset of each basic block in a linked program"""
+        leaders = { 0, prog.entry }
+        for pc in range(len(prog)):
+            opcode = prog.code[pc]
+            if opcode in JUMPS:
+                leaders.add(prog.arg1[pc])
+            if opcode in cls.ENDS:
+                leaders.add(pc + 1)
+        return sorted(x for x in leaders if x < len(prog))
+
+    def closure(self, opcode, arg1):
+        """- Returns a closure executing one non-jump instruction
+        Args:
+            opcode :str: The instruction opcode
+            arg1 :Any: The first operand
+        """
+        V = self.vars
+        push = self.stack.append
+        pop = self.stack.pop
+        interpolate = self.interpolate
+        if opcode == 'EMIT':
+            emit = self.output.append
+            return lambda: emit(interpolate(arg1))
+        elif opcode == 'WRITE':
+            emit = self.output.append
+            return lambda: emit(arg1)
+        elif opcode == 'GET':
+            return lambda: push(V[arg1])
+        elif opcode == 'CONST':
+            return lambda: push(arg1)
+        elif opcode == 'EVAL2':
+            cmp = self.EVAL2.get(arg1)
+            def eval2():
+                a = pop()
+                b = pop()
+                if cmp is None:
+                    raise ValueError(f"Invalid condition {arg1}")
+                push(cmp(a, b))
+            return eval2
+        elif opcode == 'EVAL1':
+            if arg1 == '!':
+                return lambda: push(not pop())
+            elif arg1 == 'defined':
+                return lambda: push(pop() in V)
+            def eval1():
+                raise ValueError(f"Invalid condition {arg1}")
+            return eval1
+        elif opcode == 'SET':
+            defines = self.defines
+            def setvar():
+                val = pop()
+                V[arg1] = val
+                defines.set(arg1, val, V)
+            return setvar
+        elif opcode == 'INCLUDE':
+            def include():
+                raise NotImplementedError("Not implemented INCLUDE")
+            return include
+        elif opcode == 'EXISTS':
+            return lambda: push(arg1 in V)
+        elif opcode == 'FATAL':
+            def fatal():
+                print(arg1, file=sys.stderr)
+                sys.exit(1)
+            return fatal
+        return lambda: None
+
+    def compile(self, prog : Program=None):
+        """- Prepares a linked program for execution, see compile_block
+        Args:
+            prog :Program: The program to compile, defaults to linking progmem
+        Returns:
+            :Tuple[List[tuple], List[callable], List[int], int]: the closures of each block,
+            the closure returning the next block of each block, the start offset of each block
+            and the index of the entry block.  Blocks not compiled yet are None
+        """
+        if prog is None:
+            prog = Program.link(self.progmem)
+        starts = self.blocks(prog)
+        self.linked = (prog, starts, { pc: n for n, pc in enumerate(starts) })
+        self.sizes = [ end - start for start, end in zip(starts, starts[1:] + [len(prog)]) ]
+        return [ None ] * len(starts), [ None ] * len(starts), starts, self.linked[2][prog.entry]
+
+    def fuse_condition(self, prog : Program, start : int, end : int, block_of : dict, nxt : int):
+        """- Fuses the condition ending a block into one closure returning the next block
+        Recognizes 'CONST v, GET x, EVAL2 op, JMPIF' from '#if x op "v"' and
+        'CONST x, EVAL1 defined, JMPIF' from '#ifdef x', also with an 'EVAL1 !' before the
+        JMPIF as PreprocessorParser emits them, which then need no stack.
+        Returns:
+            :Tuple[int, callable]: the offset the fused instructions start at and the closure,
+            or None if the block does not end with such a condition
+        """
+        code = prog.code
+        if end - start < 3 or code[end-1] != OPCODE['JMPIF']:
+            return None
+        V = self.vars
+        taken, fallthrough = block_of[prog.arg1[end-1]], nxt
+        end -= 1
+        if code[end-1] == OPCODE['EVAL1'] and prog.operand(prog.arg1[end-1]) == '!':
+            taken, fallthrough = fallthrough, taken
+            end -= 1
+        if (end - start >= 3 and code[end-3] == OPCODE['CONST'] and code[end-2] == OPCODE['GET']
+                and code[end-1] == OPCODE['EVAL2']):
+            cmp = self.EVAL2.get(prog.operand(prog.arg1[end-1]))
+            if cmp is None:
+                return None
+            value = prog.operand(prog.arg1[end-3])
+            name = prog.operand(prog.arg1[end-2])
+            return end - 3, lambda: taken if cmp(V[name], value) else fallthrough
+        if (end - start >= 2 and code[end-2] == OPCODE['CONST'] and code[end-1] == OPCODE['EVAL1']
+                and prog.operand(prog.arg1[end-1]) == 'defined'):
+            name = prog.operand(prog.arg1[end-2])
+            return end - 2, lambda: taken if name in V else fallthrough
+        return None
+
+    def compile_block(self, n : int):
+        """- Compiles one basic block into closures, the first time it is executed
+        Branches that are never taken are never compiled, so a run never costs more than
+        interpreting the instructions it executes.
+        Args:
+            n :int: The block index
+        Returns:
+            :Tuple[tuple, callable]: the closures of the block and the closure returning the
+            index of the next block
+        """
+        prog, starts, block_of = self.linked
+        code = prog.code
+        emit_op = OPCODE['EMIT']
+        extend = self.output.extend
+        interpolate = self.interpolate
+        pop = self.stack.pop
+        end = starts[n+1] if n+1 < len(starts) else len(prog)
+        body = []
+        nxt = n + 1
+        term = lambda: nxt
+        pc = starts[n]
+        fused = self.fuse_condition(prog, pc, end, block_of, nxt)
+        if fused:
+            end, term = fused
+        while pc < end:
+            if code[pc] == emit_op:
+                # a run of EMITs becomes one call over a tuple of lines
+                run = pc
+                while run < end and code[run] == emit_op:
+                    run += 1
+                lines = tuple(prog.operand(x) for x in prog.arg1[pc:run])
+                body.append(lambda lines=lines: extend(map(interpolate, lines)))
+                pc = run
+                continue
+            opcode, arg1, arg2 = prog.instruction(pc)
+            if opcode == 'JMPIF':
+                target = block_of[arg1]
+                term = lambda: target if pop() else nxt
+            elif opcode == 'JMP':
+                target = block_of[arg1]
+                term = lambda: target
+            elif opcode == 'HALT':
+                term = lambda: -1
+            else:
+                body.append(self.closure(opcode, arg1))
+            pc += 1
+        return tuple(body), term
+
+    def execute(self, prog : Program=None):
+        """- Runs a linked program, by default the one in progmem
+        Args:
+            prog :Program: The program to run
+        """
+        bodies, ends, starts, n = self.compile(prog)
+        sizes = self.sizes
+        steps = 0
+        self.running = True
+        try:
+            while n >= 0:
+                self.pc = starts[n]
+                body = bodies[n]
+                if body is None:
+                    body, ends[n] = self.compile_block(n)
+                    bodies[n] = body
+                for op in body:
+                    op()
+                steps += sizes[n]
+                n = ends[n]()
+        except Exception as e:
+            print(self.pc, str(e))
+            raise e
+        finally:
+            self.steps += steps
+        self.running = False
+
+    def stream(self, prog : Program=None):
+        """- Runs a linked program, yielding the output of each block as soon as it ran
+        Args:
+            prog :Program: The program to run
+        """
+        bodies, ends, starts, n = self.compile(prog)
+        sizes = self.sizes
+        steps = 0
+        output = self.output
+        self.running = True
+        try:
+            while n >= 0:
+                self.pc = starts[n]
+                body = bodies[n]
+                if body is None:
+                    body, ends[n] = self.compile_block(n)
+                    bodies[n] = body
+                for op in body:
+                    op()
+                steps += sizes[n]
+                n = ends[n]()
+                if output:
+                    yield from output
+                    output.clear()
+        except Exception as e:
+            print(self.pc, str(e))
+            raise e
+        finally:
+            self.steps += steps
+        self.running = False
+
+
+# Optimizer, specializes a program for the defines it is run with
+UNKNOWN = object()      # whether the define exists is not known
+DEFINED = object()      # the define exists but its value is not known
+WRITE_CHUNK = 1 << 16   # WRITE chunks are merged up to about this many characters
+
+def merge_defines(a : dict, b : dict) -> dict:
+    """- Returns what is known about the defines where two paths of a program join
+    Args:
+        a :dict: define name to value, DEFINED or UNKNOWN on one path, None if it is not taken
+        b :dict: the same for the other path
+    """
+    if a is None:
+        return b
+    if b is None:
+        return a
+    result = {}
+    names_a = list(a)
+    names_b = list(b)
+    ordered = True
+    for n, name in enumerate(dict.fromkeys(names_a + names_b)):
+        x = a.get(name, UNKNOWN)
+        y = b.get(name, UNKNOWN)
+        # the define table is ordered, a define added in a different position on each path
+        # is only known to exist
+        ordered = ordered and n < len(names_a) and n < len(names_b) and names_a[n] == names_b[n]
+        if x is UNKNOWN or y is UNKNOWN:
+            result[name] = UNKNOWN
+        elif ordered and x is not DEFINED and y is not DEFINED and type(x) is type(y) and x == y:
+            result[name] = x
+        else:
+            result[name] = DEFINED
+    return result
+
+
+def fold_condition(opcode : str, cond : str, args : list, defines : dict):
+    """- Evaluates an EVAL1 or EVAL2 instruction on known operands
+    Returns:
+        :Any: the result, or UNKNOWN if it depends on the run or fails, which is then left
+        to fail at run time
+    """
+    try:
+        if opcode == 'EVAL2':
+            # the VM pops the operand pushed last first
+            cmp = CompiledPreprocessorVM.EVAL2.get(cond)
+            return UNKNOWN if cmp is None else cmp(args[1], args[0])
+        if cond == '!':
+            return not args[0]
+        if cond == 'defined':
+            if args[0] not in defines:
+                return False
+            return UNKNOWN if defines[args[0]] is UNKNOWN else True
+    except Exception:
+        pass
+    return UNKNOWN
+
+
+def optimize(instructions : List[Instruction], env : dict, shared : dict=None) -> List[Instruction]:
+    """- Specializes a program for the defines it starts with
+    Conditions on known defines are folded and the branches they never take are removed with
+    their jumps and labels.  Where every define is known, EMIT lines are interpolated ahead of
+    time into WRITE instructions, and adjacent WRITEs are merged into chunks.  Programs the
+    pass does not expect, such as ones jumping backwards, are returned unchanged.
+    Args:
+        instructions :List[Instruction]: The program, entered at the 'main' label
+        env :dict: The defines the program is run with
+        shared :dict: Memo of interpolated text for specializing one program for several
+        environments, text is only interpolated again if a define it contains differs
+    """
+    def interpolate(lines):
+        text = "".join(lines)
+        if shared is None:
+            return index.interpolate(text)
+        if not index.sequential(text):
+            key = (text, tuple((name, value) for name, value in index.table.items() if value is not None and name in text))
+        else:
+            key = (text, tuple(index.table.items()))
+        result = shared.get(key)
+        if result is None:
+            result = shared[key] = index.interpolate(text)
+        return result
+
+    pure = ('CONST', 'GET', 'EXISTS', 'EVAL1', 'EVAL2')
+    out = []
+    stack = []      # (value or UNKNOWN, offset in out of the instructions computing it)
+    pending = { 'main': dict(env) }
+    seen = set()
+    defines = None  # what is known about the defines here, None where nothing runs
+    index = None
+    indexes = {}
+    lines = []      # EMIT lines interpolated together into one WRITE
+    for i in instructions:
+        opcode, arg1 = i.opcode, i.arg1
+        if lines and (opcode != 'EMIT' or not lines[-1].endswith("\n")):
+            # defines never span a newline, so the lines can be substituted as one text
+            out.append(Instruction('WRITE', interpolate(lines)))
+            lines = []
+        if opcode == 'LABEL':
+            if stack:
+                return instructions
+            seen.add(arg1)
+            defines = merge_defines(defines, pending.pop(arg1, None))
+            index = None
+            if defines is not None:
+                out.append(i)
+            continue
+        if defines is None:
+            continue
+        start = len(out)
+        if opcode == 'CONST':
+            stack.append((arg1, start))
+            out.append(i)
+        elif opcode in ('GET', 'EXISTS'):
+            value = defines.get(arg1, UNKNOWN)
+            if opcode == 'EXISTS':
+                value = fold_condition('EVAL1', 'defined', [ arg1 ], defines)
+            if value is UNKNOWN or value is DEFINED:
+                stack.append((UNKNOWN, start))
+                out.append(i)
+            else:
+                stack.append((value, start))
+                out.append(Instruction('CONST', value))
+        elif opcode in ('EVAL1', 'EVAL2'):
+            n = 1 if opcode == 'EVAL1' else 2
+            if len(stack) < n:
+                return instructions
+            args = stack[-n:]
+            del stack[-n:]
+            start = args[0][1]
+            value = UNKNOWN
+            if (all(v is not UNKNOWN for v, _ in args)
+                    and all(x.opcode in pure for x in out[start:])):
+                value = fold_condition(opcode, arg1, [ v for v, _ in args ], defines)
+            if value is UNKNOWN:
+                out.append(i)
+            else:
+                del out[start:]
+                out.append(Instruction('CONST', value))
+            stack.append((value, start))
+        elif opcode in ('JMPIF', 'JMP'):
+            value = True
+            if opcode == 'JMPIF':
+                if not stack:
+                    return instructions
+                value, start = stack.pop()
+                if value is not UNKNOWN and all(x.opcode in pure for x in out[start:]):
+                    del out[start:]
+                    opcode = 'JMP' if value else None
+                else:
+                    out.append(i)
+            if stack or arg1 in seen:
+                return instructions
+            if opcode is not None:
+                pending[arg1] = merge_defines(pending.get(arg1), defines)
+            if opcode == 'JMP':
+                out.append(Instruction('JMP', arg1))
+                defines = None
+        elif opcode == 'SET':
+            if not stack:
+                return instructions
+            value, _ = stack.pop()
+            defines = dict(defines)
+            if value is UNKNOWN or defines.get(arg1) is UNKNOWN:
+                value = DEFINED
+            defines[arg1] = value
+            index = None
+            out.append(i)
+        elif opcode == 'EMIT':
+            if index is None:
+                key = tuple(defines.items())
+                index = indexes.get(key)
+                if index is None:
+                    known = all(v is not UNKNOWN and v is not DEFINED for v in defines.values())
+                    index = indexes[key] = DefineIndex(defines) if known else False
+            if index:
+                lines.append(arg1)
+            else:
+                out.append(i)
+        else:
+            out.append(i)
+            if opcode in ('HALT', 'FATAL'):
+                defines = None
+    if lines:
+        out.append(Instruction('WRITE', interpolate(lines)))
+    if pending:
+        return instructions
+
+    # drop the jumps to a label right after them, then the labels no jump refers to, and
+    # merge adjacent WRITEs
+    kept = []
+    for n, i in enumerate(out):
+        if i.opcode == 'JMP':
+            k = n + 1
+            while k < len(out) and out[k].opcode == 'LABEL' and out[k].arg1 != i.arg1:
+                k += 1
+            if k < len(out) and out[k].opcode == 'LABEL':
+                continue
+        kept.append(i)
+    used = { i.arg1 for i in kept if i.opcode in ('JMP', 'JMPIF') }
+    result = []
+    chunk = []
+    size = 0
+    for i in kept:
+        if i.opcode == 'LABEL' and i.arg1 != 'main' and i.arg1 not in used:
+            continue
+        if chunk and (i.opcode != 'WRITE' or size >= WRITE_CHUNK):
+            result.append(Instruction('WRITE', "".join(chunk)))
+            chunk = []
+            size = 0
+        if i.opcode == 'WRITE':
+            chunk.append(i.arg1)
+            size += len(i.arg1)
+        else:
+            result.append(i)
+    if chunk:
+        result.append(Instruction('WRITE', "".join(chunk)))
+    return result
+
 
 # Syntax definition for the preprocessor
 preprocessor_bnf = r"""
@@ -465,10 +1620,17 @@ def unwrap_str(s):
     return s
 
 
-# Parser tree transformer to output file (as a list of lines)
-class ParsePreprocessor(Transformer):
-    def __init__(self, vm : PreprocessorVM):
+# Parser tree transformer to output file (as a list of lines), load_lark() combines it with
+# lark's Transformer
+class ParsePreprocessor:
+    def __init__(self, vm : PreprocessorVM, stack : tuple=()):
+        """- Construct ParsePreprocessor
+        Args:
+            vm :PreprocessorVM: The VM the instructions are generated for
+            stack :Tuple[str]: The real paths of the file being parsed and the files including it
+        """
         self.vm = vm
+        self.stack = stack
 
     def start(self, v):
         block = v[0]
@@ -490,7 +1652,7 @@ class ParsePreprocessor(Transformer):
 
     def setsymbol(self, v):
         var = v[1].value
-        value = True
+        value = [ Instruction('CONST', True) ]
         if len(v) > 2:
             value = v[2]
 
@@ -501,6 +1663,9 @@ class ParsePreprocessor(Transformer):
         #print(f"node setsymbol  {result}", file=sys.stderr)
         return result
 
+    def include(self, v):
+        return include_fragment(self.vm, self.stack, unwrap_str(v[1].value))
+
     def body(self, v):
         result = [ Instruction('EMIT', x.value) for x in v ]
         #print(f"node body  {result}", file=sys.stderr)
@@ -525,7 +1690,7 @@ class ParsePreprocessor(Transformer):
         truecase = self.vm.gensym()
         xcontinue = self.vm.gensym()
         result = bexpr + [
-            Instruction('IFJMP', truecase)
+            Instruction('JMPIF', truecase)
         ] + falsestart + [
             Instruction('JMP', xcontinue),
             Instruction('LABEL', truecase)
@@ -539,7 +1704,7 @@ class ParsePreprocessor(Transformer):
     def condbody2(self, v):
         sym = v[1].value
         truestart = v[2]
-        falsestart = v[4] if len(v)==5 else []
+        falsestart = v[4] if len(v)==6 else []
 
         # ifdef sym block1 else block2
         truecase = self.vm.gensym()
@@ -548,7 +1713,7 @@ class ParsePreprocessor(Transformer):
         result = [
             Instruction('CONST', sym),
             Instruction('EVAL1', 'defined'),
-            Instruction('IFJMP', truecase)
+            Instruction('JMPIF', truecase)
         ] + falsestart + [
             Instruction('JMP', xcontinue),
             Instruction('LABEL', truecase)
@@ -593,56 +1758,1100 @@ class ParsePreprocessor(Transformer):
         return result
 
 
-def preprocess(fp : Fpos, environ : dict={}) -> str:
+class TemplateSyntaxError(Exception):
+    """A template that is not in the preprocessor language, the message gives the position"""
+
+
+class PreprocessorParser:
+    """Recursive descent parser for the preprocessor_bnf language.  It reads the tokens of
+    the lexer one at a time and appends the instructions of each construct to a single list
+    as soon as it is recognized, so no parse tree is built and nested blocks are never
+    copied.  A conditional is laid out in source order, with the condition negated to jump
+    over the true block:
+
+        <bexpr> EVAL1 ! JMPIF else <true block> JMP end LABEL else <false block> LABEL end
+
+    It accepts the same language as the Lark parser with ParsePreprocessor, which stays the
+    reference implementation, and its programs produce the same output"""
+    def __init__(self, vm : PreprocessorVM, stack : tuple=()):
+        """- Construct PreprocessorParser
+        Args:
+            vm :PreprocessorVM: The VM the instructions are generated for
+            stack :Tuple[str]: The real paths of the file being parsed and the files including it
+        """
+        self.vm = vm
+        self.stack = stack
+        self.code = []
+        self.tokens = None
+        self.token = None
+
+    def parse(self, tokens) -> List[Instruction]:
+        """- Parses a token stream into instructions
+        Args:
+            tokens :Iterable[Token]: The tokens, see CompiledPreprocessorLexer.lex
+        """
+        self.tokens = iter(tokens)
+        self.advance()
+        for _ in self.block():
+            pass
+        if self.token is not None:
+            self.error("end of file")
+        self.code.append(Instruction('HALT'))
+        return self.code
+
+    def stream(self, tokens):
+        """- Parses a token stream, yielding the instructions of each item as soon as it is
+        recognized.  Only the instructions of the current item are held, see
+        PreprocessorVM.run_stream
+        Args:
+            tokens :Iterable[Token]: The tokens, see CompiledPreprocessorLexer.lex
+        """
+        self.tokens = iter(tokens)
+        self.advance()
+        for _ in self.block():
+            if self.code:
+                yield self.code
+                self.code = []
+        if self.token is not None:
+            self.error("end of file")
+        yield [ Instruction('HALT') ]
+
+    def advance(self):
+        token = self.token
+        self.token = next(self.tokens, None)
+        return token
+
+    def error(self, expected : str):
+        """- Raises TemplateSyntaxError for the current token"""
+        token = self.token
+        where = self.stack[-1] if self.stack else "<template>"
+        if token is None:
+            raise TemplateSyntaxError(f"{where}: unexpected end of file, expected {expected}")
+        raise TemplateSyntaxError(
+            f"{where}:{token.line + 1}:{token.column + 1}: unexpected {token.type} {token.value!r}, expected {expected}")
+
+    def expect(self, kind : str):
+        if self.token is None or self.token.type != kind:
+            self.error(kind)
+        return self.advance()
+
+    def block(self):
+        """- block: anyitem*, stops at a token no item starts with.  Yields after each item"""
+        while self.token is not None:
+            code = self.code
+            kind = self.token.type
+            if kind == 'TEXT':
+                code.append(Instruction('EMIT', self.advance().value))
+            elif kind == 'IF':
+                self.advance()
+                self.bexpr()
+                yield from self.conditional()
+            elif kind == 'IFDEF':
+                self.advance()
+                code.append(Instruction('CONST', self.expect('SYMBOL').value))
+                code.append(Instruction('EVAL1', 'defined'))
+                yield from self.conditional()
+            elif kind == 'INCLUDE':
+                self.advance()
+                name = unwrap_str(self.expect('STRING').value)
+                code.extend(include_fragment(self.vm, self.stack, name))
+            elif kind == 'DEFINE':
+                self.advance()
+                var = self.expect('SYMBOL').value
+                if self.token is not None and self.token.type in ('SYMBOL', 'STRING'):
+                    code.append(self.operand())
+                else:
+                    code.append(Instruction('CONST', True))
+                code.append(Instruction('SET', var))
+            else:
+                return
+            yield
+
+    def conditional(self):
+        """- The rest of condbody after the condition: block [ELSE block] ENDIF"""
+        xelse = self.vm.gensym()
+        self.code.append(Instruction('EVAL1', '!'))
+        self.code.append(Instruction('JMPIF', xelse))
+        yield from self.block()
+        if self.token is None or self.token.type not in ('ELSE', 'ENDIF'):
+            self.error("ELSE or ENDIF")
+        if self.token.type == 'ELSE':
+            self.advance()
+            xcontinue = self.vm.gensym()
+            self.code.append(Instruction('JMP', xcontinue))
+            self.code.append(Instruction('LABEL', xelse))
+            yield from self.block()
+            xelse = xcontinue
+        self.expect('ENDIF')
+        self.code.append(Instruction('LABEL', xelse))
+
+    def bexpr(self):
+        """- bexpr: expr COMP expr | UNARY bexpr | DEFINED ( SYMBOL )"""
+        kind = self.token.type if self.token is not None else None
+        if kind == 'UNARY':
+            op = self.advance().value
+            self.bexpr()
+            self.code.append(Instruction('EVAL1', op))
+        elif kind == 'DEFINED':
+            self.advance()
+            self.expect('(')
+            sym = self.expect('SYMBOL').value
+            self.expect(')')
+            self.code.append(Instruction('CONST', sym))
+            self.code.append(Instruction('EVAL1', 'defined'))
+        else:
+            # the right operand is pushed first, as ParsePreprocessor.expr2 does
+            a = self.operand()
+            cmp = self.expect('COMP').value
+            b = self.operand()
+            self.code.extend([ b, a, Instruction('EVAL2', cmp) ])
+
+    def operand(self) -> Instruction:
+        """- expr: SYMBOL | STRING, returns the instruction pushing it"""
+        kind = self.token.type if self.token is not None else None
+        if kind == 'SYMBOL':
+            return Instruction('GET', self.advance().value)
+        elif kind == 'STRING':
+            return Instruction('CONST', unwrap_str(self.advance().value))
+        self.error("SYMBOL or STRING")
+
+
+lark_frontend = None
+def load_lark():
+    """- Imports lark and builds the parser front end on first use, shared by every render
+    Running a compiled program never calls this, so it does not pay for the lark import.
+    Returns:
+        :Tuple[Lark, type]: the preprocessor parser and the lark Transformer for ParsePreprocessor
+    """
+    global lark_frontend, Token
+    if lark_frontend is None:
+        from lark import Lark, Transformer
+        from lark.lexer import Lexer, Token
+        def lex(self, data):
+            # replays an already lexed token list, see parse_template
+            if isinstance(data, list):
+                return iter(data)
+            return CompiledPreprocessorLexer.lex(self, data)
+        lexer = type("LarkPreprocessorLexer", (CompiledPreprocessorLexer, Lexer), { "lex": lex })
+        transformer = type("LarkParsePreprocessor", (ParsePreprocessor, Transformer), {})
+        lark_frontend = (Lark(preprocessor_bnf, parser='lalr', lexer=lexer), transformer)
+    return lark_frontend
+
+
+include_path = []
+def find_include(name : str, base : str) -> str:
+    """- Resolves the file of '#include "name"'
+    A relative name is looked up next to the including file, then in each -I directory.
+    Args:
+        name :str: The included name
+        base :str: The directory of the including file
+    Returns:
+        :str: the real path of the file
+    """
+    dirs = [ "" ] if os.path.isabs(name) else [ base ] + include_path
+    for d in dirs:
+        path = os.path.join(d, name)
+        if os.path.isfile(path):
+            return os.path.realpath(path)
+    raise FileNotFoundError(f"#include \"{name}\" not found in {', '.join(dirs)}")
+
+
+def include_fragment(vm : PreprocessorVM, stack : tuple, name : str) -> List[Instruction]:
+    """- Returns the instructions '#include "name"' is replaced with
+    Args:
+        vm :PreprocessorVM: The VM the instructions are generated for, which records the include
+        stack :Tuple[str]: The real paths of the file including it and the files including that
+        name :str: The included name
+    """
+    base = os.path.dirname(stack[-1]) if stack else "."
+    path = find_include(name, base)
+    instructions, includes = [], ()
+    if path not in stack:
+        instructions, includes = load_fragment(path, stack)
+    for x in (path,) + includes:
+        if x in stack:
+            chain = stack[stack.index(x):] + (x,)
+            raise ValueError(f"#include cycle {' -> '.join(chain)}")
+        if x not in vm.includes:
+            vm.includes.append(x)
+
+    # the fragment is shared, so its labels are renamed for this copy
+    labels = {}
+    result = []
+    for i in instructions:
+        if i.opcode in ('LABEL', 'JMP', 'JMPIF'):
+            lbl = labels.get(i.arg1)
+            if lbl is None:
+                lbl = labels[i.arg1] = vm.gensym()
+            i = Instruction(i.opcode, lbl)
+        result.append(i)
+    return result
+
+
+def file_stamps(paths) -> tuple:
+    """- Returns the mtime and size of each file, None if one of them is gone"""
+    try:
+        return tuple((st.st_mtime_ns, st.st_size) for st in map(os.stat, paths))
+    except OSError:
+        return None
+
+
+fragment_cache = {}
+def load_fragment(path : str, stack : tuple=()):
+    """- Returns the instructions of an included file, parsing it only once per run
+    The instructions do not depend on the defines, which are applied when the program runs,
+    so one parse serves every template and environment including the file.  The instructions
+    hold the files it includes in turn, so it is parsed again when the mtime or size of any
+    of them changes.
+    Args:
+        path :str: The real path of the file
+        stack :Tuple[str]: The real paths of the files including it
+    Returns:
+        :Tuple[List[Instruction], Tuple[str]]: the instructions without the main label and
+        HALT, and the real paths of the files it includes in turn
+    """
+    cached = fragment_cache.get(path)
+    if cached and cached[0] is not None and cached[0] == file_stamps((path,) + cached[1][1]):
+        if profile:
+            profile.count("include_cache_hits")
+        return cached[1]
+    if profile:
+        profile.count("include_cache_misses")
+    # stamped before the parse, so an edit made while it runs is parsed next time
+    stamp = file_stamps((path,))
+    vm = PreprocessorVM()
+    parse_template(Fpos(path), vm, stack)
+    fragment = (vm.progmem[1:-1], tuple(vm.includes))
+    nested = file_stamps(fragment[1])
+    fragment_cache[path] = (stamp + nested if stamp is not None and nested is not None else None, fragment)
+    return fragment
+
+
+use_lark = False
+def parse_template(fp : Fpos, vm : PreprocessorVM, stack : tuple=()):
+    """- Parses the input file 'fp' and loads the instructions into 'vm'
+    Uses PreprocessorParser, or the Lark parser and ParsePreprocessor if 'use_lark' is set.
+    Args:
+        fp :Fpos: The file to be read from
+        vm :PreprocessorVM: The VM to load
+        stack :Tuple[str]: The real paths of the files including 'fp'
+    """
+    if fp.path:
+        stack = stack + (os.path.realpath(fp.path),)
+    if profile:
+        # lex up front so lexing and parsing are timed separately
+        with phase("lex"):
+            fp = list(CompiledPreprocessorLexer().lex(fp))
+        profile.count("tokens", len(fp))
+    if not use_lark:
+        tokens = fp if isinstance(fp, list) else CompiledPreprocessorLexer().lex(fp)
+        with phase("parse"):
+            vm.prog(PreprocessorParser(vm, stack).parse(tokens))
+        if profile:
+            profile.count("instructions", len(vm.progmem))
+        return
+
+    parser, transformer = load_lark()
+    with phase("parse"):
+        tree = parser.parse(fp)
+    #print(tree)
+    with phase("transform"):
+        try:
+            vm.prog(transformer(vm, stack).transform(tree))
+        except Exception as e:
+            # lark wraps the errors of the transformer, such as a missing #include
+            if hasattr(e, "orig_exc"):
+                raise e.orig_exc from None
+            raise
+    if profile:
+        profile.count("instructions", len(vm.progmem))
+
+
+def execute(vm : PreprocessorVM, prog : Program=None):
+    """- Executes a loaded VM, or a linked program on a CompiledPreprocessorVM"""
+    with phase("execute"):
+        if prog is None:
+            vm.execute()
+        else:
+            vm.execute(prog)
+    if profile:
+        profile.count("vm_steps", vm.steps)
+
+
+def specialize(vm : PreprocessorVM, prog : Program=None) -> Program:
+    """- Optimizes the program loaded in 'vm', or a linked program, for the defines of 'vm'
+    Args:
+        vm :PreprocessorVM: The VM the program runs on, before it runs
+        prog :Program: The linked program, the program loaded in 'vm' if not given
+    Returns:
+        :Program: the optimized linked program, None when the loaded program was optimized
+    """
+    with phase("optimize"):
+        if prog is None:
+            vm.progmem = optimize(vm.progmem, vm.vars)
+            return None
+        return Program.link(optimize(prog.instructions(), vm.vars))
+
+
+def compile_template(fp : Fpos) -> Program:
+    """- Parses the input file 'fp' into a linked program
+    Args:
+        fp :Fpos: The file to be read from
+    """
+    vm = PreprocessorVM()
+    parse_template(fp, vm)
+    with phase("link"):
+        prog = Program.link(vm.progmem)
+    prog.includes = [ (path, template_digest(path)) for path in vm.includes ]
+    return prog
+
+
+def preprocess(fp : Fpos, environ : dict={}, vm_class=PreprocessorVM, optimized : bool=True,
+               includes : list=None) -> str:
     """- Runs the preprocessor on the input file 'fp' and returns the result as a string
     Args:
         fp :Fpos: The file to be read from
         environ :Dict[str, str]: The initial environment defines
+        vm_class :type: The execution backend, PreprocessorVM is the reference implementation
+        optimized :bool: Specialize the program for 'environ' before running it, see optimize
+        includes :list: Collects the real paths of the files the template includes
     """
     # Generate preprocessor script from input and execute the script in a VM
+    vm = vm_class(environ)
+    parse_template(fp, vm)
+    if includes is not None:
+        includes.extend(vm.includes)
+    if optimized:
+        specialize(vm)
+    execute(vm)
+    return "".join(vm.output)
+
+
+def preprocess_stream(fp : Fpos, environ : dict={}, vm_class=PreprocessorVM, optimized : bool=True,
+                      includes : list=None):
+    """- Runs the preprocessor on the input file 'fp', yielding the output line by line
+    Each item is executed as soon as it is parsed and then released, so with a StreamingFpos
+    only the current line, the open conditionals and the included files are held in memory.
+    The Lark parser, with 'use_lark', builds the whole program first.
+    Args:
+        fp :Fpos: The file to be read from, use StreamingFpos to read it lazily
+        environ :Dict[str, str]: The initial environment defines
+        vm_class :type: The execution backend, PreprocessorVM is the reference implementation
+        optimized :bool: Specialize the program for 'environ' before running it, see optimize.
+        Only with 'use_lark', a program run while it is parsed is never whole
+        includes :list: Collects the real paths of the files the template includes
+    """
+    vm = vm_class(environ)
+    if use_lark:
+        parse_template(fp, vm)
+        if optimized:
+            specialize(vm)
+        yield from vm.stream()
+    else:
+        stack = (os.path.realpath(fp.path),) if fp.path else ()
+        parser = PreprocessorParser(vm, stack)
+        yield from vm.run_stream(parser.stream(CompiledPreprocessorLexer().lex(fp)))
+    if includes is not None:
+        includes.extend(vm.includes)
+    if profile:
+        profile.count("vm_steps", vm.steps)
+
+
+def run_program(prog : Program, environ : dict={}, optimized : bool=True) -> str:
+    """- Runs a linked program and returns the result as a string
+    Args:
+        prog :Program: The program, see compile_template and load_program
+        environ :Dict[str, str]: The initial environment defines
+        optimized :bool: Specialize the program for 'environ' before running it, see optimize
+    """
+    # each block of a program runs at most once, so PreprocessorVM beats compiling the blocks
     vm = PreprocessorVM(environ)
-    parser = Lark(preprocessor_bnf, parser='lalr', lexer=PreprocessorLexer)
-    tree = parser.parse(fp)
-    #print(tree)
-    vm.prog(ParsePreprocessor(vm).transform(tree))
-    vm.execute()
+    vm.progmem = prog.instructions()
+    if optimized:
+        specialize(vm)
+    execute(vm)
     return "".join(vm.output)
 
 
+def run_program_stream(prog : Program, environ : dict={}, optimized : bool=True):
+    """- Runs a linked program, yielding the output line by line
+    Args:
+        prog :Program: The program, see compile_template and load_program
+        environ :Dict[str, str]: The initial environment defines
+        optimized :bool: Specialize the program for 'environ' before running it, see optimize
+    """
+    vm = PreprocessorVM(environ)
+    vm.progmem = prog.instructions()
+    if optimized:
+        specialize(vm)
+    yield from vm.stream()
+    if profile:
+        profile.count("vm_steps", vm.steps)
+
+
+def program_path(template_file : str) -> str:
+    return f"{template_file}.prog"
+
+
+def template_digest(template_file : str) -> str:
+    with open(template_file, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+program_cache = {}
+def load_program(template_file : str) -> Program:
+    """- Returns the compiled program of a template from '<template>.prog'
+    A missing artifact, or one that is stale because the template, a file it includes, the
+    artifact format or the Python version changed, is compiled again and rewritten.  Programs
+    stay in memory for the run, so a daemon only reads an artifact again when it changed.
+    Args:
+        template_file :str: The template
+    """
+    digest = template_digest(template_file)
+    try:
+        with phase("load_program"):
+            cached = program_cache.get(template_file)
+            prog = cached[1] if cached and cached[0] == digest else Program.load(program_path(template_file), digest)
+            for path, include_digest in prog.includes:
+                if template_digest(path) != include_digest:
+                    raise ValueError(f"stale program {program_path(template_file)}, {path} changed")
+            program_cache[template_file] = (digest, prog)
+            return prog
+    except (OSError, ValueError, EOFError, TypeError) as e:
+        print(f"compiling {template_file}: {e}")
+    prog = compile_template(Fpos(template_file))
+    try:
+        prog.save(program_path(template_file), digest)
+    except OSError as e:
+        # an unwritable artifact only costs a parse on the next run
+        print(f"not saving {program_path(template_file)}: {e}")
+    program_cache[template_file] = (digest, prog)
+    return prog
+
+
+def write_stream(lines, output_file : str):
+    """- Writes lines to 'output_file' as they are produced
+    The lines go to a temporary file next to the output, which replaces the output only if
+    no errors were reported, so a failed render never leaves a partial file behind.
+    Args:
+        lines :Iterable[str]: The output lines
+        output_file :str: The file to write
+    """
+    tmp_file = f"{output_file}.tmp"
+    error_count = errors.error_count
+    try:
+        with open(tmp_file, "wt") as f:
+            for line in lines:
+                f.write(line)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_file)
+        raise
+    if errors.error_count > error_count:
+        os.remove(tmp_file)
+        return False
+    os.replace(tmp_file, output_file)
+    return True
+
+
+# Render cache, a manifest next to each output records the fingerprint of its inputs
+RENDER_CACHE_VERSION = 2
+render_cache = { "hits": 0, "misses": 0 }
+
+def manifest_path(output_file : str) -> str:
+    return f"{output_file}.manifest"
+
+
+def variable_version(vartype : str, varname : str) -> str:
+    """- Returns the current value, or for secrets a version, of a variable reference"""
+    if vartype == "secret":
+        name = varname.split(".")[0]
+        version = secret_backend.get_version(SecretId.by_value(name))
+        if version is None:
+            value = json.dumps(get_secret(name), sort_keys=True)
+            version = hashlib.sha256(value.encode()).hexdigest()
+        return version
+    elif vartype == "env":
+        return os.environ.get(varname)
+    elif vartype == "setting.sh":
+        return get_setting(varname)
+    return None
+
+
+def fingerprint(template_file : str, env : dict, references : List[List[str]], includes : List[str]=()) -> str:
+    """- Fingerprints the inputs of a render
+    Args:
+        template_file :str: The template
+        env :Dict[str, str]: The initial environment defines
+        references :List[List[str]]: The (type, name) variables referenced by the output
+        includes :List[str]: The files included by the template
+    """
+    h = hashlib.sha256()
+    h.update(f"{RENDER_CACHE_VERSION}\0".encode())
+    for path in [ template_file ] + list(includes):
+        with open(path, "rb") as f:
+            h.update(f.read())
+    h.update(json.dumps(env, sort_keys=True).encode())
+    for vartype, varname in references:
+        h.update(json.dumps([vartype, varname, variable_version(vartype, varname)]).encode())
+    return h.hexdigest()
+
+
+def render_is_current(template_file : str, env : dict, output_file : str) -> bool:
+    """- True if 'output_file' was rendered from the same inputs as now
+    The referenced variables and included files are read from the manifest; they can only
+    change if the template, an included file or the defines change, which the fingerprint
+    covers as well.
+    """
+    try:
+        with open(manifest_path(output_file), "rt") as f:
+            manifest = json.load(f)
+        if not os.path.isfile(output_file):
+            return False
+        return manifest["fingerprint"] == fingerprint(template_file, env, manifest["references"], manifest["includes"])
+    except Exception:
+        return False
+
+
+def save_manifest(template_file : str, env : dict, output_file : str, resolved : dict, includes : List[str]):
+    """- Records the fingerprint of a render, 'resolved' is the interpolation memo table"""
+    references = sorted(list(variable_pattern.fullmatch(span).groups()) for span in resolved)
+    manifest = {
+        "template": template_file,
+        "references": references,
+        "includes": includes,
+        "fingerprint": fingerprint(template_file, env, references, includes),
+    }
+    with open(manifest_path(output_file), "wt") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def template_files(paths : List[str], pattern : str):
+    """- Expands the template arguments, a directory stands for the files in it matching 'pattern'
+    Args:
+        paths :List[str]: Template files and directories
+        pattern :str: Glob pattern for templates in a directory
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(glob.glob(os.path.join(path, pattern)))
+        else:
+            yield path
+
+
+def render_template(template_file : str, env : dict, stream : bool=False, force : bool=False, run : bool=False):
+    """- Renders one template to the file without the '.template' suffix, or to stdout
+    Failures are reported through the ErrorReport and leave the output untouched.  A file
+    output is skipped when its manifest shows it was rendered from the same inputs.
+    Args:
+        template_file :str: The template to render
+        env :Dict[str, str]: The initial environment defines, not modified
+        stream :bool: Render line by line, see preprocess_stream
+        force :bool: Render even if the output is current
+        run :bool: Execute the compiled program in '<template>.prog' instead of parsing
+    """
+    print(template_file)
+    if not os.path.isfile(template_file):
+        errors.error(f"No such template '{template_file}'")
+        return
+    env = dict(env)
+    secret_cache.begin_document()
+    output_file = template_file[:-9] if template_file.endswith(".template") else None
+    if output_file:
+        with phase("render_cache_check"):
+            current = not force and render_is_current(template_file, env, output_file)
+        if current:
+            print(f"unchanged {output_file}")
+            render_cache["hits"] += 1
+            return
+        render_cache["misses"] += 1
+    defines = dict(env)
+    resolved = {}
+    includes = []
+    error_count = errors.error_count
+    try:
+        prog = load_program(template_file) if run else None
+        if prog:
+            includes = [ path for path, _ in prog.includes ]
+        if stream:
+            # read, process and write the template line by line
+            if prog:
+                lines = run_program_stream(prog, env)
+            else:
+                lines = preprocess_stream(StreamingFpos(template_file), env, includes=includes)
+            lines = find_replace_variables_stream(lines, resolved)
+            if output_file:
+                print(f"writing {output_file}")
+                with phase("stream"):
+                    written = write_stream(lines, output_file)
+                if written:
+                    save_manifest(template_file, defines, output_file, resolved, includes)
+            else:
+                for line in lines:
+                    sys.stdout.write(line)
+                # as print(body) does without --stream
+                sys.stdout.write("\n")
+            return
+
+        if prog:
+            body = run_program(prog, env)
+        else:
+            # read template
+            #print(f"reading {template_file}")
+            fp = Fpos(template_file)
+            body = preprocess(fp, env, includes=includes)
+
+        # process template
+        with phase("find_replace_variables"):
+            body = find_replace_variables(body, resolved)
+    except Exception as e:
+        errors.error(f"{template_file}: {type(e).__name__}: {e}")
+        return
+    if errors.error_count > error_count:
+        return
+
+    # write output
+    if output_file:
+        print(f"writing {output_file}")
+        with phase("write"):
+            with open(output_file, "wt") as f:
+                f.write(body)
+            save_manifest(template_file, defines, output_file, resolved, includes)
+    else:
+        print(body)
+
+
+def render_worker(job):
+    """- Renders one template in a pool process
+    Returns:
+        :Tuple[int, int, int, dict]: the number of errors reported, render cache hits and
+        misses, and the profile data if profiling
+    """
+    global profile
+    error_count = errors.error_count
+    hits, misses = render_cache["hits"], render_cache["misses"]
+    template_file, env, stream, force, run, profiling = job
+    if profiling:
+        profile = Profile()
+    render_template(template_file, env, stream, force, run)
+    data = profile.as_dict() if profile else None
+    profile = None
+    return errors.error_count - error_count, render_cache["hits"] - hits, render_cache["misses"] - misses, data
+
+
+# Matrix rendering, one parse of a template serves every environment
+def load_matrix(path : str) -> dict:
+    """- Reads the environments of a matrix render
+    The file maps each environment name to its defines, as JSON or, if PyYAML is installed,
+    as YAML:  { "dev": { "ENV": "dev" }, "prod": { "ENV": "prod", "NAMESPACE": "tline-prod" } }
+    Args:
+        path :str: The .json, .yaml or .yml file
+    """
+    with open(path, "rt") as f:
+        if path.endswith((".yaml", ".yml")):
+            import yaml
+            matrix = yaml.safe_load(f)
+        else:
+            matrix = json.load(f)
+    if not isinstance(matrix, dict) or not all(isinstance(v, dict) for v in matrix.values()):
+        raise ValueError(f"{path}: expected a mapping of environment names to defines")
+    for name in matrix:
+        # the name is the directory of the environment's outputs, see matrix_output
+        name = str(name)
+        if name in ("", ".", "..") or any(sep and sep in name for sep in ("/", os.sep, os.altsep, "\0")):
+            raise ValueError(f"{path}: environment {name!r} is not a plain directory name")
+    return { str(name): { str(k): str(v) for k, v in defines.items() } for name, defines in matrix.items() }
+
+
+def matrix_output(output_file : str, name : str) -> str:
+    """- Returns the output of an environment, in a directory named after it next to the template"""
+    return os.path.join(os.path.dirname(output_file), name, os.path.basename(output_file))
+
+
+def render_output(job):
+    """- Runs a specialized program and writes its output, see render_matrix
+    Args:
+        job :tuple: (template_file, env, output_file, prog, includes, profiling), profiling is
+        set in pool processes to profile the job on its own
+    Returns:
+        :Tuple[int, dict]: the number of errors reported, and the profile data if profiling
+    """
+    global profile
+    template_file, env, output_file, prog, includes, profiling = job
+    if profiling:
+        profile = Profile()
+    error_count = errors.error_count
+    secret_cache.begin_document()
+    resolved = {}
+    try:
+        body = run_program(prog, dict(env), optimized=False)
+        with phase("find_replace_variables"):
+            body = find_replace_variables(body, resolved)
+    except Exception as e:
+        errors.error(f"{output_file}: {type(e).__name__}: {e}")
+        body = None
+    if errors.error_count == error_count:
+        print(f"writing {output_file}")
+        with phase("write"):
+            os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+            with open(output_file, "wt") as f:
+                f.write(body)
+            save_manifest(template_file, env, output_file, resolved, includes)
+    data = profile.as_dict() if profiling else None
+    if profiling:
+        profile = None
+    return errors.error_count - error_count, data
+
+
+def render_matrix(template_file : str, matrix : dict, env : dict, force : bool=False, run : bool=False, jobs : int=1):
+    """- Renders a template once for each environment of a matrix from a single parse
+    The program is specialized for each environment with optimize, sharing the interpolation
+    of text whose defines are the same in several environments, and the specialized programs
+    run in a process pool if 'jobs' > 1.  Each output goes to a directory named after its
+    environment, see matrix_output, and is skipped if its manifest shows it is current.
+    Args:
+        template_file :str: The template to render
+        matrix :Dict[str, Dict[str, str]]: The defines of each environment, see load_matrix
+        env :Dict[str, str]: The defines common to all environments
+        force :bool: Render even if an output is current
+        run :bool: Use the compiled program in '<template>.prog' instead of parsing
+        jobs :int: Number of processes running the environments
+    """
+    print(template_file)
+    if not template_file.endswith(".template") or not os.path.isfile(template_file):
+        errors.error(f"No such template '{template_file}'")
+        return
+    output_file = template_file[:-9]
+    try:
+        prog = load_program(template_file) if run else compile_template(Fpos(template_file))
+    except Exception as e:
+        errors.error(f"{template_file}: {type(e).__name__}: {e}")
+        return
+    includes = [ path for path, _ in prog.includes ]
+    instructions = prog.instructions()
+    shared = {}
+    work = []
+    for name, defines in matrix.items():
+        environ = dict(env)
+        environ.update(defines)
+        output = matrix_output(output_file, name)
+        if not force and render_is_current(template_file, environ, output):
+            print(f"unchanged {output}")
+            render_cache["hits"] += 1
+            continue
+        render_cache["misses"] += 1
+        with phase("optimize"):
+            specialized = Program.link(optimize(instructions, environ, shared))
+        work.append((template_file, environ, output, specialized, includes))
+    if jobs > 1 and len(work) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            work = [ job + (profile is not None,) for job in work ]
+            for error_count, data in pool.map(render_output, work):
+                errors.error_count += error_count
+                if data:
+                    profile.merge(data)
+    else:
+        for job in work:
+            render_output(job + (False,))
+
+
+# Daemon mode, the parser, compiled programs, settings and secret cache stay warm between renders
+def parse_request(args : List[str]):
+    """- Parses the arguments of a daemon render request
+    Args:
+        args :List[str]: [-D <VARNAME>=<value>]... [--stream] [--force] [--run] [--glob <pattern>] <templatefile|directory>...
+    Returns:
+        :Tuple[dict, bool, bool, bool, List[str]]: the defines, the stream, force and run flags
+        and the templates
+    """
+    args = Arglist(args)
+    env = {}
+    stream = force = run = False
+    pattern = "*.template"
+    paths = []
+    while len(args) > 0:
+        opt = args.shift()
+        if opt == "-D":
+            var, val = args.shift().split('=', 1)
+            env[var] = val
+        elif opt == "--stream":
+            stream = True
+        elif opt == "--force":
+            force = True
+        elif opt == "--run":
+            run = True
+        elif opt == "--glob":
+            pattern = args.shift()
+        elif opt.startswith("-"):
+            raise ValueError(f"unsupported option {opt}")
+        else:
+            paths.append(opt)
+    templates = list(template_files(paths, pattern))
+    if not templates:
+        raise ValueError("no templates")
+    return env, stream, force, run, templates
+
+
+def daemon_request(line : str):
+    """- Renders the templates of one daemon request, capturing everything it prints
+    Args:
+        line :str: The request, shell quoted arguments as for parse_request
+    Returns:
+        :Tuple[int, str]: the exit status and the output
+    """
+    output = StringIO()
+    error_count = errors.error_count
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        try:
+            env, stream, force, run, templates = parse_request(shlex.split(line))
+            for template_file in templates:
+                render_template(template_file, env, stream, force, run)
+        except Exception as e:
+            errors.error(f"{type(e).__name__}: {e}")
+    return (1 if errors.error_count > error_count else 0), output.getvalue()
+
+
+class Watcher:
+    """Polls the files the watched templates depend on and re-renders a template when one of
+    them changed.  The dependencies are the template, the files it includes according to its
+    manifest, setting.sh and the --secrets file; the render cache then decides whether the
+    output really has to be rendered again"""
+    def __init__(self, paths : List[str], pattern : str, env : dict, stream : bool=False, run : bool=False):
+        """- Construct Watcher
+        Args:
+            paths :List[str]: Template files and directories, directories are expanded on each poll
+            pattern :str: Glob pattern for templates in a directory
+            env :Dict[str, str]: The initial environment defines
+            stream :bool: Render line by line
+            run :bool: Render from compiled programs
+        """
+        self.paths = paths
+        self.pattern = pattern
+        self.env = env
+        self.stream = stream
+        self.run = run
+        self.stamps = {}
+        self.inputs = None
+
+    @staticmethod
+    def stamp(paths : List[str]) -> tuple:
+        """- Returns the (path, mtime, size) of each file, None for a missing one"""
+        result = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                result.append((path, st.st_mtime_ns, st.st_size))
+            except OSError:
+                result.append((path, None))
+        return tuple(result)
+
+    def dependencies(self, template_file : str) -> List[str]:
+        """- Returns the files the output of a template depends on"""
+        paths = [ template_file ]
+        output_file = template_file[:-9] if template_file.endswith(".template") else None
+        if output_file:
+            try:
+                with open(manifest_path(output_file), "rt") as f:
+                    paths.extend(json.load(f).get("includes", []))
+            except (OSError, ValueError):
+                pass
+        return paths
+
+    def poll(self) -> int:
+        """- Re-renders the templates whose dependencies changed since the last poll
+        Returns:
+            :int: the number of templates rendered
+        """
+        global settings
+        inputs = [ "setting.sh" ]
+        if isinstance(secret_backend, FileSecretBackend):
+            inputs.append(secret_backend.path)
+        inputs = self.stamp(inputs)
+        if inputs != self.inputs:
+            # the shared inputs changed, drop what was loaded from them
+            if self.inputs is not None:
+                settings = None
+                secret_cache.values.clear()
+                self.stamps.clear()
+                if isinstance(secret_backend, FileSecretBackend):
+                    try:
+                        secret_backend.load()
+                    except (OSError, ValueError) as e:
+                        errors.error(f"{secret_backend.path}: {type(e).__name__}: {e}")
+            self.inputs = inputs
+        rendered = 0
+        for template_file in template_files(self.paths, self.pattern):
+            if self.stamp(self.dependencies(template_file)) == self.stamps.get(template_file):
+                continue
+            render_template(template_file, self.env, self.stream, False, self.run)
+            self.stamps[template_file] = self.stamp(self.dependencies(template_file))
+            rendered += 1
+        return rendered
+
+
+def serve(socket_path : str=None, watcher : Watcher=None, interval : float=1.0):
+    """- Runs the daemon until it is terminated
+    Render requests are served on the Unix socket 'socket_path', one per connection.  A request
+    is a line of shell quoted arguments, see parse_request, with paths relative to the working
+    directory of the daemon.  The reply is everything the render printed, followed by a last
+    line 'exit <status>', so a shell caller needs no Python:
+
+        echo '-D ENV=dev --run /tmp/sonarqube_cnf.patch.template' | nc -U /tmp/fill-template.sock
+
+    Between requests, and at least every 'interval' seconds, 'watcher' is polled.
+    Args:
+        socket_path :str: The Unix socket to listen on, None to only watch
+        watcher :Watcher: The templates to keep rendered, None to only serve requests
+        interval :float: Seconds between polls of the watcher
+    """
+    import signal
+    import socketserver
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline().decode()
+            status, output = daemon_request(line)
+            print(f"request {line.strip()!r}: exit {status}")
+            self.wfile.write(output.encode())
+            self.wfile.write(f"exit {status}\n".encode())
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server = None
+    if socket_path:
+        if os.path.exists(socket_path) and stat.S_ISSOCK(os.stat(socket_path).st_mode):
+            os.remove(socket_path)
+        server = socketserver.UnixStreamServer(socket_path, RequestHandler)
+        server.timeout = interval
+        print(f"listening at {socket_path}")
+    try:
+        while True:
+            if watcher:
+                watcher.poll()
+            if server:
+                server.handle_request()
+            else:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server:
+            server.server_close()
+            os.remove(socket_path)
+
+
 def main(args : Arglist):
+    global secret_backend, profile, use_lark
     app = args.shift()
     print("app", app)
     #process options
     env = {}
+    stream = False
+    jobs = 1
+    force = False
+    run = False
+    compile_only = False
+    profile_json = None
+    daemon_socket = None
+    matrix = None
+    watch = False
+    interval = 1.0
+    pattern = "*.template"
+    if len(args) == 0:
+        usage()
     opt = args.shift()
     # print("opt", opt)
-    while opt == "-D":
-        var,val = args.shift().split('=', 1)
-        #print("var,val", var,val)
-        env[var] = val
+    while opt in ("-D", "-I", "--lark", "--stream", "--force", "--compile", "--run", "--profile", "--profile-json",
+                  "-j", "--glob", "--secrets", "--secret-ttl", "--daemon", "--watch", "--interval", "--matrix"):
+        if opt == "-D":
+            var,val = args.shift().split('=', 1)
+            #print("var,val", var,val)
+            env[var] = val
+        elif opt == "-I":
+            include_path.append(args.shift())
+        elif opt == "--lark":
+            use_lark = True
+        elif opt == "--force":
+            force = True
+        elif opt == "--compile":
+            compile_only = True
+        elif opt == "--run":
+            run = True
+        elif opt == "--profile":
+            profile = Profile()
+        elif opt == "--profile-json":
+            profile = Profile()
+            profile_json = args.shift()
+        elif opt == "-j":
+            jobs = int(args.shift())
+        elif opt == "--glob":
+            pattern = args.shift()
+        elif opt == "--secrets":
+            secret_backend = FileSecretBackend(args.shift())
+        elif opt == "--secret-ttl":
+            secret_cache.ttl = float(args.shift())
+        elif opt == "--daemon":
+            daemon_socket = args.shift()
+        elif opt == "--watch":
+            watch = True
+        elif opt == "--interval":
+            interval = float(args.shift())
+        elif opt == "--matrix":
+            matrix = load_matrix(args.shift())
+        elif opt == "--stream":
+            stream = True
+        if len(args) == 0:
+            if daemon_socket is None:
+                usage()
+            opt = None
+            break
         opt = args.shift()
         #print(opt)
-    template_file = opt
-    print(template_file)
-    if not os.path.isfile(template_file):
+    paths = ([ opt ] if opt else []) + args.args
+    if daemon_socket or watch:
+        if watch and not paths:
+            usage()
+        watcher = Watcher(paths, pattern, env, stream, run) if watch else None
+        serve(daemon_socket, watcher, interval)
+        return
+    templates = list(template_files(paths, pattern))
+    if len(templates) == 0:
         usage()
 
-    # read template
-    #print(f"reading {template_file}")
-    fp = Fpos(template_file)
-
-    # process template
-    body = find_replace_variables(preprocess(fp, env))
-    errors.exit_on_error()
-
-    # write output
-    if template_file.endswith(".template"):
-        output_file = template_file[:-9]
-        print(f"writing {output_file}")
-        with open(output_file, "wt") as f:
-            f.write(body)
+    if compile_only:
+        for template_file in templates:
+            print(f"compiling {template_file} to {program_path(template_file)}")
+            try:
+                compile_template(Fpos(template_file)).save(program_path(template_file), template_digest(template_file))
+            except Exception as e:
+                errors.error(f"{template_file}: {type(e).__name__}: {e}")
+    elif matrix is not None:
+        for template_file in templates:
+            render_matrix(template_file, matrix, env, force, run, jobs)
+    elif jobs > 1 and len(templates) > 1:
+        # render templates in a process pool, each process shares its parser, settings and secrets
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            render_jobs = [ (t, env, stream, force, run, profile is not None) for t in templates ]
+            for error_count, hits, misses, data in pool.map(render_worker, render_jobs):
+                errors.error_count += error_count
+                render_cache["hits"] += hits
+                render_cache["misses"] += misses
+                if data:
+                    profile.merge(data)
     else:
-        print(body)
+        # render templates, sharing the parser, settings and secrets
+        for template_file in templates:
+            render_template(template_file, env, stream, force, run)
+    if render_cache["hits"] + render_cache["misses"] > 0:
+        print(f"render cache: {render_cache['hits']} hits, {render_cache['misses']} misses")
+    if profile:
+        profile.count("render_cache_hits", render_cache["hits"])
+        profile.count("render_cache_misses", render_cache["misses"])
+        if profile_json:
+            with open(profile_json, "wt") as f:
+                json.dump(profile.as_dict(), f, indent=2)
+        else:
+            profile.report(sys.stderr)
+    errors.exit_on_error()
 
 if __name__ == "__main__":
-    main(Arglist(sys.argv))
\ No newline at end of file
+    main(Arglist(sys.argv))
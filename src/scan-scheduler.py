@@ -0,0 +1,522 @@
+"""Clones and scans Foundry code repositories with sonar-scanner, several at a time.
+
+Replaces the one-at-a-time loop of sonarscan.sh.  Clones are network bound and scans are CPU and
+memory bound, so each runs on its own pool: --clone-jobs clones at once, and at most --scan-jobs
+scans, fewer if the container memory does not hold that many --scan-memory budgets.  A cloned
+repository waits for a scan slot, and cloning pauses once enough clones are waiting.  Every
+step has a timeout, and with --window no step starts or keeps running past the window, so the
+run ends before the next CronJob schedule, which concurrencyPolicy: Forbid would skip otherwise.
+A JSON summary of the durations and failures is printed, or written to --summary.
+
+Scans are incremental: the --state file records, per project key, the remote, commit, scanner
+version and scanner properties of the last successful analysis, and a repository matching them
+is not scanned again unless --force is given.  The remote HEAD is compared with 'git ls-remote'
+first, so an unchanged repository is not even cloned.  The state file keeps remote URLs without
+credentials; a remote that needs them is read with the credentials fsm clone used for another
+repository on the same host in this run, so the first of them is cloned.  The state file must be
+on a volume that outlives the pod, see cron.yaml.template, without it every run scans everything.
+
+    python3 /opt/scan-scheduler.py --clone-jobs 4 --scan-jobs 2 --window 82800 <repository>...
+    python3 /opt/scan-scheduler.py --list repositories.txt --summary /tmp/scan-summary.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ScanJob:
+    """One repository on its way through clone and scan, with what the summary reports"""
+    def __init__(self, repo : str):
+        self.repo = repo
+        self.projdir = os.path.basename(repo.rstrip("/")).replace(" ", "-")
+        self.status = "pending"
+        self.error = None
+        self.clone_seconds = None
+        self.scan_wait_seconds = None
+        self.scan_seconds = None
+        self.cloned = None
+        self.commit = None
+        self.remote = None
+        self.previous_commit = None
+        self.reason = None
+        self.logs = []
+
+    @property
+    def project_key(self):
+        return f"ank:{self.projdir}"
+
+    def as_dict(self):
+        return {
+            "repository": self.repo,
+            "project_key": self.project_key,
+            "status": self.status,
+            "error": self.error,
+            "commit": self.commit,
+            "previous_commit": self.previous_commit,
+            "scan_reason": self.reason,
+            "clone_seconds": self.clone_seconds,
+            "scan_wait_seconds": self.scan_wait_seconds,
+            "scan_seconds": self.scan_seconds,
+            "logs": self.logs,
+        }
+
+
+def memory_limit_mb():
+    """- Returns the memory the container may use in MB, from the cgroup limit or else MemTotal"""
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path, "rt") as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # cgroup v1 reports an unlimited group as a huge number
+        if value != "max" and int(value) < 1 << 60:
+            return int(value) // (1 << 20)
+    with open("/proc/meminfo", "rt") as f:
+        for line in f:
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1]) // 1024
+    return None
+
+
+def scan_slots(scan_jobs : int, scan_memory : int, reserve : int):
+    """- Returns how many scans can run at once within the container memory
+    Args:
+        scan_jobs :int: Scans wanted at once
+        scan_memory :int: Memory budget of one scanner JVM in MB
+        reserve :int: Memory kept for the clones and everything else in MB
+    """
+    limit = memory_limit_mb()
+    if limit is None:
+        return scan_jobs
+    return max(1, min(scan_jobs, (limit - reserve) // scan_memory))
+
+
+class ScanState:
+    """Last successful analysis per project key, kept in a JSON file: the commit scanned, the
+    scanner version and a hash of the scanner properties.  The file is rewritten after each
+    scan, so a run that is stopped keeps what it scanned"""
+    def __init__(self, path : str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.projects = {}
+        try:
+            with open(path, "rt") as f:
+                self.projects = json.load(f).get("projects", {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"ignoring scan state {path}: {e}", flush=True)
+
+    def reason_to_scan(self, job, scanner : dict):
+        """- Returns why a job must be scanned, None if its last analysis is still current"""
+        last = self.projects.get(job.project_key)
+        if last is None:
+            return "not scanned before"
+        job.previous_commit = last.get("commit")
+        if job.commit is None:
+            return "commit unknown"
+        if job.commit != job.previous_commit:
+            return "new commits"
+        if last.get("scanner_version") != scanner["version"]:
+            return "scanner version changed"
+        if last.get("properties_hash") != scanner["properties_hash"]:
+            return "scanner properties changed"
+        return None
+
+    def remote(self, job):
+        """- Returns the remote URL recorded for a job, None if there is none"""
+        return self.projects.get(job.project_key, {}).get("remote")
+
+    def record(self, job, scanner : dict):
+        """- Records a successful scan and saves the file"""
+        with self.lock:
+            self.projects[job.project_key] = {
+                "commit": job.commit,
+                "remote": job.remote,
+                "scanner_version": scanner["version"],
+                "properties_hash": scanner["properties_hash"],
+                "scanned_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "scan_seconds": job.scan_seconds,
+            }
+            directory = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(directory, exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "wt") as f:
+                json.dump({ "projects": self.projects }, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.path)
+
+
+def scanner_identity(sonar_scanner : str):
+    """- Returns the version of the sonar-scanner installation and a hash of its properties
+    The version is the name of the installation directory /opt/sonar-scanner links to, and the
+    hash covers conf/sonar-scanner.properties, which setup patches with the server settings
+    """
+    home = os.path.dirname(os.path.dirname(os.path.realpath(sonar_scanner)))
+    digest = hashlib.sha256()
+    try:
+        with open(os.path.join(home, "conf", "sonar-scanner.properties"), "rb") as f:
+            digest.update(f.read())
+    except OSError:
+        pass
+    return { "version": os.path.basename(home), "properties_hash": digest.hexdigest() }
+
+
+def git_output(*args : str):
+    """- Returns the output of a git command, None if it fails"""
+    # a remote asking for credentials fails instead of waiting for a terminal
+    env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+    try:
+        result = subprocess.run([ "git", *args ], capture_output=True, text=True, timeout=60,
+                                stdin=subprocess.DEVNULL, env=env)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return result.stdout.strip() if result.returncode == 0 else None
+
+
+def head_commit(path : str):
+    """- Returns the commit checked out in a clone, None if git cannot tell"""
+    return git_output("-C", path, "rev-parse", "HEAD")
+
+
+def origin_url(path : str):
+    """- Returns the URL a clone was made from, None if git cannot tell"""
+    return git_output("-C", path, "remote", "get-url", "origin")
+
+
+def split_credentials(url : str):
+    """- Returns a remote URL without the credentials in it, and the credentials, None if it has none"""
+    parts = urllib.parse.urlsplit(url)
+    if not (parts.username or parts.password):
+        return url, None
+    credentials, host = parts.netloc.rsplit("@", 1)
+    return urllib.parse.urlunsplit(parts._replace(netloc=host)), credentials
+
+
+def credentials_key(url : str):
+    """- Returns the scheme and host the credentials of a remote URL are kept under"""
+    parts = urllib.parse.urlsplit(url)
+    return parts.scheme, parts.netloc
+
+
+def remote_head(url : str, credentials : str=None):
+    """- Returns the commit HEAD points to in a remote repository, None if it cannot be read
+    Args:
+        url :str: The remote URL, without credentials
+        credentials :str: 'user:password' to put in the URL the way fsm clone does, if any
+    """
+    if credentials:
+        parts = urllib.parse.urlsplit(url)
+        url = urllib.parse.urlunsplit(parts._replace(netloc=f"{credentials}@{parts.netloc}"))
+    output = git_output("ls-remote", url, "HEAD")
+    return output.split()[0] if output else None
+
+
+class Scheduler:
+    """Runs the clone and scan steps of the jobs on two bounded pools"""
+    def __init__(self, args, scan_jobs : int, state : ScanState=None, scanner : dict=None):
+        self.args = args
+        self.scan_jobs = scan_jobs
+        self.state = state
+        self.scanner = scanner
+        self.clone_pool = ThreadPoolExecutor(max_workers=args.clone_jobs, thread_name_prefix="clone")
+        self.scan_pool = ThreadPoolExecutor(max_workers=scan_jobs, thread_name_prefix="scan")
+        # repositories cloned or being cloned and not scanned yet, so clones do not run far ahead
+        # of the scans and fill the disk
+        self.pending = threading.BoundedSemaphore(args.clone_jobs + scan_jobs)
+        self.deadline = time.monotonic() + args.window if args.window else None
+        self.stopping = threading.Event()
+        self.processes = set()
+        self.lock = threading.Lock()
+        self.outstanding = 0
+        self.done = threading.Condition(self.lock)
+        # credentials fsm clone put in the remote URLs, by scheme and host, so 'git ls-remote'
+        # can read remotes that need them.  The state file only has the URLs without them
+        self.credentials = {}
+
+    def remaining(self):
+        """- Returns the seconds left in the window, None without a window"""
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def closed(self):
+        remaining = self.remaining()
+        return self.stopping.is_set() or (remaining is not None and remaining <= 0)
+
+    def run(self, jobs : list):
+        """- Runs every job through clone and scan, returns once all are finished or skipped"""
+        seen = set()
+        for job in jobs:
+            if job.projdir in seen:
+                job.status = "skipped"
+                job.error = f"duplicate project directory {job.projdir}"
+                continue
+            seen.add(job.projdir)
+            while not self.pending.acquire(timeout=1):
+                if self.closed():
+                    break
+            else:
+                if not self.closed():
+                    with self.lock:
+                        self.outstanding += 1
+                    self.clone_pool.submit(self.clone, job)
+                    continue
+                self.pending.release()
+            job.status = "skipped"
+            job.error = "scan window closed" if not self.stopping.is_set() else "stopped"
+        with self.done:
+            while self.outstanding:
+                self.done.wait()
+        self.clone_pool.shutdown()
+        self.scan_pool.shutdown()
+
+    def finish(self, job):
+        self.pending.release()
+        with self.done:
+            self.outstanding -= 1
+            self.done.notify_all()
+
+    def clone(self, job):
+        # every way out that does not hand the job to a scan finishes it, or run() waits forever
+        submitted = False
+        try:
+            if self.state is not None and not self.args.force and self.unchanged_remote(job):
+                return
+            job.status = "cloning"
+            t = time.monotonic()
+            ok = self.step(job, "clone", [ self.args.fsm, "clone", job.repo ], None, self.args.clone_timeout)
+            job.clone_seconds = round(time.monotonic() - t, 3)
+            if not ok:
+                return
+            job.status = "cloned"
+            if self.state is not None:
+                path = os.path.join(self.args.git_helper, job.projdir)
+                job.commit = head_commit(path)
+                url = origin_url(path)
+                if url:
+                    job.remote, credentials = split_credentials(url)
+                    if credentials:
+                        with self.lock:
+                            self.credentials[credentials_key(job.remote)] = credentials
+                job.reason = "forced" if self.args.force else self.state.reason_to_scan(job, self.scanner)
+                if job.reason is None:
+                    job.status = "unchanged"
+                    print(f"[scan] {job.projdir} unchanged at {job.commit}, skipped", flush=True)
+                    return
+            job.cloned = time.monotonic()
+            self.scan_pool.submit(self.scan, job)
+            submitted = True
+        except Exception as e:
+            job.status = "clone_failed"
+            job.error = f"{type(e).__name__}: {e}"
+            print(f"[clone] {job.projdir} failed: {job.error}", flush=True)
+        finally:
+            if not submitted:
+                self.finish(job)
+
+    def unchanged_remote(self, job):
+        """- Returns true if the remote HEAD of a job is the commit of its last analysis, which
+        then needs no clone.  Only a repository recorded with its remote URL can be checked"""
+        remote = self.state.remote(job)
+        if remote is None:
+            return False
+        with self.lock:
+            credentials = self.credentials.get(credentials_key(remote))
+        commit = remote_head(remote, credentials)
+        if commit is None:
+            return False
+        job.commit = commit
+        job.remote = remote
+        job.reason = self.state.reason_to_scan(job, self.scanner)
+        if job.reason is not None:
+            job.commit = None
+            return False
+        job.status = "unchanged"
+        print(f"[clone] {job.projdir} unchanged at {commit}, clone skipped", flush=True)
+        return True
+
+    def scan(self, job):
+        job.scan_wait_seconds = round(time.monotonic() - job.cloned, 3)
+        try:
+            if self.closed():
+                job.status = "skipped"
+                job.error = "scan window closed" if not self.stopping.is_set() else "stopped"
+                return
+            job.status = "scanning"
+            env = dict(os.environ)
+            # the heap gets 3/4 of the budget, the rest covers the JVM's own memory
+            heap = f"-Xmx{self.args.scan_memory * 3 // 4}m"
+            env["SONAR_SCANNER_OPTS"] = f"{env.get('SONAR_SCANNER_OPTS', '')} {heap}".strip()
+            command = [ self.args.sonar_scanner, "-D", f"sonar.projectKey={job.project_key}" ]
+            t = time.monotonic()
+            ok = self.step(job, "scan", command, os.path.join(self.args.git_helper, job.projdir),
+                           self.args.scan_timeout, env)
+            job.scan_seconds = round(time.monotonic() - t, 3)
+            if ok:
+                job.status = "ok"
+                if self.state is not None and job.commit is not None:
+                    self.state.record(job, self.scanner)
+        finally:
+            self.finish(job)
+
+    def step(self, job, name : str, command : list, cwd : str, timeout : float, env : dict=None):
+        """- Runs one step of a job with its output in a log file, killing it on timeout
+        Returns:
+            :bool: True if the step succeeded, else the job status and error say why
+        """
+        remaining = self.remaining()
+        window = remaining is not None and remaining < timeout
+        if window:
+            timeout = max(remaining, 0)
+        log_path = os.path.join(self.args.log_dir, f"{job.projdir}.{name}.log")
+        job.logs.append(log_path)
+        print(f"[{name}] {job.projdir} started", flush=True)
+        try:
+            with open(log_path, "wb") as log:
+                process = subprocess.Popen(command, cwd=cwd, env=env, stdin=subprocess.DEVNULL, stdout=log,
+                                           stderr=subprocess.STDOUT, start_new_session=True)
+        except OSError as e:
+            job.status = f"{name}_failed"
+            job.error = str(e)
+            print(f"[{name}] {job.projdir} failed: {e}", flush=True)
+            return False
+        with self.lock:
+            self.processes.add(process)
+        try:
+            returncode = process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            kill(process)
+            returncode = None
+        finally:
+            with self.lock:
+                self.processes.discard(process)
+        if returncode == 0:
+            print(f"[{name}] {job.projdir} ok", flush=True)
+            return True
+        if self.stopping.is_set():
+            job.status, job.error = "stopped", f"{name} stopped"
+        elif returncode is None:
+            job.status = f"{name}_timeout"
+            job.error = f"{name} ran past the scan window" if window else f"{name} took over {timeout:.0f}s"
+        else:
+            job.status = f"{name}_failed"
+            job.error = f"{name} exited with status {returncode}"
+        print(f"[{name}] {job.projdir} {job.status}: {job.error}, see {log_path}", flush=True)
+        return False
+
+    def stop(self):
+        """- Stops starting steps and kills the running ones, e.g. when the pod is terminated"""
+        self.stopping.set()
+        with self.lock:
+            processes = list(self.processes)
+        for process in processes:
+            kill(process, grace=0)
+
+
+def kill(process, grace : float=10):
+    """- Terminates a step and everything it started, killing it if it is still running after 'grace' seconds"""
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            process.wait(grace)
+            return
+        except subprocess.TimeoutExpired:
+            pass
+    process.wait()
+
+
+def read_list(path : str):
+    """- Reads repositories one per line, skipping blank lines and '#' comments"""
+    with open(path, "rt") as f:
+        return [ line.strip() for line in f if line.strip() and not line.lstrip().startswith("#") ]
+
+
+def summarize(jobs : list, args, scan_jobs : int, started : float, wall : float):
+    counts = {}
+    for job in jobs:
+        counts[job.status] = counts.get(job.status, 0) + 1
+    return {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(started)),
+        "wall_seconds": round(wall, 3),
+        "clone_jobs": args.clone_jobs,
+        "scan_jobs": scan_jobs,
+        "scan_memory_mb": args.scan_memory,
+        "window_seconds": args.window,
+        "counts": counts,
+        "scanned": counts.get("ok", 0),
+        "unchanged": counts.get("unchanged", 0),
+        "clone_seconds_total": round(sum(j.clone_seconds or 0 for j in jobs), 3),
+        "scan_seconds_total": round(sum(j.scan_seconds or 0 for j in jobs), 3),
+        "repositories": [ job.as_dict() for job in jobs ],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Clone and scan repositories with sonar-scanner in parallel")
+    parser.add_argument("repositories", nargs="*", help="Foundry code repository paths")
+    parser.add_argument("--list", action="append", default=[], help="file of repositories, one per line")
+    parser.add_argument("--clone-jobs", type=int, default=4, help="clones at once")
+    parser.add_argument("--scan-jobs", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="scans at once, fewer if the memory does not hold them")
+    parser.add_argument("--scan-memory", type=int, default=2048, help="memory budget of one scan in MB")
+    parser.add_argument("--reserve-memory", type=int, default=1024, help="memory in MB not given to scans")
+    parser.add_argument("--clone-timeout", type=float, default=1800, help="seconds one clone may take")
+    parser.add_argument("--scan-timeout", type=float, default=7200, help="seconds one scan may take")
+    parser.add_argument("--window", type=float, help="seconds after which no step starts or keeps running")
+    parser.add_argument("--state", default=os.environ.get("SCAN_STATE", "/opt/sonarqube/scan-state/scan-state.json"),
+                        help="scan state file, on a persistent volume")
+    parser.add_argument("--no-state", action="store_true", help="scan every repository and record nothing")
+    parser.add_argument("--force", action="store_true", help="scan repositories even if unchanged")
+    parser.add_argument("--summary", help="JSON summary file, stdout if not given")
+    parser.add_argument("--log-dir", default="/tmp/scan-logs", help="directory of the clone and scan logs")
+    parser.add_argument("--git-helper", default="/opt/sonarqube/git-helper", help="where fsm clone puts repositories")
+    parser.add_argument("--sonar-scanner", default="/opt/sonar-scanner/bin/sonar-scanner")
+    parser.add_argument("--fsm", default="fsm")
+    args = parser.parse_args()
+
+    repos = list(args.repositories)
+    for path in args.list:
+        repos += read_list(path)
+    if not repos:
+        parser.error("no repositories given")
+    os.makedirs(args.log_dir, exist_ok=True)
+
+    scan_jobs = scan_slots(args.scan_jobs, args.scan_memory, args.reserve_memory)
+    if scan_jobs < args.scan_jobs:
+        print(f"memory holds {scan_jobs} of {args.scan_jobs} scans of {args.scan_memory}MB", flush=True)
+    jobs = [ ScanJob(repo) for repo in repos ]
+    state = None if args.no_state else ScanState(args.state)
+    scanner = scanner_identity(args.sonar_scanner)
+    scheduler = Scheduler(args, scan_jobs, state, scanner)
+    signal.signal(signal.SIGTERM, lambda signum, frame: scheduler.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: scheduler.stop())
+
+    started = time.time()
+    t = time.monotonic()
+    runner = threading.Thread(target=scheduler.run, args=(jobs,), name="scheduler")
+    runner.start()
+    # the main thread only waits, so the signal handlers run promptly
+    while runner.is_alive():
+        runner.join(1)
+
+    summary = summarize(jobs, args, scan_jobs, started, time.monotonic() - t)
+    if args.summary:
+        with open(args.summary, "wt") as f:
+            json.dump(summary, f, indent=2)
+    else:
+        print(json.dumps(summary, indent=2))
+    sys.exit(0 if all(job.status in ("ok", "unchanged") for job in jobs) else 1)
+
+
+if __name__ == "__main__":
+    main()
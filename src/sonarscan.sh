@@ -6,7 +6,7 @@ if [ $# -lt 1 ]; then
 fi
 
 setup() {
-    python3 /tmp/fill-template.py /tmp/sonar_scanner_cnf.patch.template
+    python3 /tmp/fill-template.py --run /tmp/sonar_scanner_cnf.patch.template
     patch -d/opt/sonar-scanner/conf -p0 </tmp/sonar_scanner_cnf.patch
 }
 
@@ -0,0 +1,70 @@
+"""Tests the define substitution of src/fill-template.py against its reference semantics, one
+str.replace per define in definition order.
+
+DefineIndex substitutes with a single scan of the text, and only replaces the defines one at
+a time in text where names overlap in a way that changes the result.
+
+    python3 test-fill-template.py
+"""
+import random
+import unittest
+
+from load_script import load_script
+
+
+ft = load_script("src/fill-template.py")
+
+
+class DefineIndexTest(unittest.TestCase):
+    def index(self, env):
+        """- Returns an index over 'env' that counts the texts replaced one define at a time"""
+        index = ft.DefineIndex(env)
+        index.fallbacks = []
+        replace_each = index.replace_each
+        def counted(body):
+            index.fallbacks.append(body)
+            return replace_each(body)
+        index.replace_each = counted
+        return index
+
+    def assertReference(self, index, body):
+        self.assertEqual(index.interpolate(body), ft.DefineIndex.replace_each(index, body))
+
+    def test_realistic_defines_take_single_scan(self):
+        env = { "ENV": "dev", "NAMESPACE": "tline-dev", "VERSION": "v1.4.2", "DEBUG": True }
+        env.update({ f"DEF_{n}": f"value-{n}" for n in range(1, 11) })
+        index = self.index(env)
+        lines = [ "namespace: NAMESPACE\n", "image: registry/app:VERSION-ENV\n",
+                  "flags: DEF_1 DEF_10 DEF_2,DEF_1\n", "debug: DEBUG\n", "ENVIRONMENT=ENV\n" ]
+        for line in lines:
+            self.assertReference(index, line)
+        self.assertEqual(index.fallbacks, [])
+        self.assertEqual(index.interpolate("DEF_10 DEF_1"), "value-10 value-1")
+
+    def test_overlaps_fall_back(self):
+        # VERSIONAMESPACE: VERSION is replaced first, NAMESPACE never matches
+        # DEF_VERSION: the value of VERSION completes DEF_1
+        index = self.index({ "NAMESPACE": "ns", "VERSION": "1.4.2", "DEF_1": "on" })
+        for line in [ "VERSIONAMESPACE\n", "DEF_VERSION\n", "NAMESPACE VERSION DEF_1\n" ]:
+            self.assertReference(index, line)
+        self.assertEqual(index.fallbacks, [ "VERSIONAMESPACE\n", "DEF_VERSION\n", "NAMESPACE VERSION DEF_1\n" ])
+        self.assertEqual(index.interpolate("DEF_VERSION"), "on.4.2")
+
+    def test_random_defines(self):
+        rnd = random.Random(7)
+        def word(lo, hi):
+            return "".join(rnd.choice("ABx") for _ in range(rnd.randint(lo, hi)))
+        for _ in range(5000):
+            env = { word(1, 3): rnd.choice([ word(0, 3), True ]) for _ in range(rnd.randint(1, 4)) }
+            index = ft.DefineIndex(env)
+            if rnd.random() < 0.3:
+                name = rnd.choice(list(env))
+                env[name] = word(0, 3)
+                index.set(name, env[name], env)
+            for _ in range(5):
+                body = word(0, 12)
+                self.assertReference(index, body)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,204 @@
+"""Tests the job accounting and the incremental scans of src/scan-scheduler.py, with the clone
+and scan steps stubbed out.
+
+A run must always end, whatever a step does: every job that is not handed to a scan has to be
+finished by its clone, or Scheduler.run waits for it forever.  A repository whose remote HEAD
+is the commit of its last analysis is neither cloned nor scanned, also when reading the remote
+needs the credentials fsm clone used.
+
+    python3 test-scan-scheduler.py
+"""
+import argparse
+import base64
+import http.server
+import os
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from load_script import load_script
+
+
+ss = load_script("src/scan-scheduler.py")
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.args = argparse.Namespace(clone_jobs=2, scan_jobs=1, scan_memory=1024, window=None,
+                                       clone_timeout=60, scan_timeout=60, force=False, log_dir=self.tmp.name,
+                                       git_helper=self.tmp.name, sonar_scanner="sonar-scanner", fsm="fsm")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def run_jobs(self, scheduler, repos):
+        """- Runs the jobs, failing the test if the run does not end"""
+        jobs = [ ss.ScanJob(repo) for repo in repos ]
+        runner = threading.Thread(target=scheduler.run, args=(jobs,), daemon=True)
+        runner.start()
+        runner.join(10)
+        self.assertFalse(runner.is_alive(), "Scheduler.run did not return")
+        return jobs
+
+    def test_clone_raises(self):
+        scheduler = ss.Scheduler(self.args, 1)
+        def step(job, name, command, cwd, timeout, env=None):
+            if job.repo == "/repos/broken":
+                raise RuntimeError("fsm vanished")
+            return True
+        scheduler.step = step
+        # more jobs than pending slots, so a leaked slot would also stall the loop in run
+        repos = [ "/repos/broken" ] + [ f"/repos/ok-{n}" for n in range(4) ]
+        jobs = self.run_jobs(scheduler, repos)
+        self.assertEqual(jobs[0].status, "clone_failed")
+        self.assertEqual(jobs[0].error, "RuntimeError: fsm vanished")
+        self.assertEqual([ job.status for job in jobs[1:] ], [ "ok" ] * 4)
+
+    def test_state_raises(self):
+        class BrokenState:
+            def remote(self, job):
+                return None
+            def reason_to_scan(self, job, scanner):
+                raise KeyError("version")
+        scheduler = ss.Scheduler(self.args, 1, BrokenState(), {})
+        scheduler.step = lambda job, name, command, cwd, timeout, env=None: True
+        jobs = self.run_jobs(scheduler, [ f"/repos/r-{n}" for n in range(5) ])
+        self.assertEqual([ job.status for job in jobs ], [ "clone_failed" ] * 5)
+
+
+class IncrementalScanTest(unittest.TestCase):
+    """Runs the scheduler three times on a local repository, with a clone step that is a plain
+    git clone and a scanner that does nothing"""
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.remote = os.path.join(self.tmp.name, "remote", "proj")
+        self.git_helper = os.path.join(self.tmp.name, "git-helper")
+        os.makedirs(self.git_helper)
+        git("init", "-q", self.remote)
+        self.commit("first")
+        fsm = os.path.join(self.tmp.name, "fsm")
+        with open(fsm, "wt") as f:
+            f.write(f'#!/bin/sh\nexec git clone -q "$2" "{self.git_helper}/$(basename "$2")"\n')
+        os.chmod(fsm, 0o755)
+        self.args = argparse.Namespace(clone_jobs=1, scan_jobs=1, scan_memory=1024, window=None,
+                                       clone_timeout=60, scan_timeout=60, force=False, log_dir=self.tmp.name,
+                                       git_helper=self.git_helper, sonar_scanner="true", fsm=fsm)
+        self.state_path = os.path.join(self.tmp.name, "state", "scan-state.json")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def commit(self, message):
+        git("-C", self.remote, "-c", "user.name=test", "-c", "user.email=test@example.com",
+            "commit", "-q", "--allow-empty", "-m", message)
+
+    def run_once(self):
+        """- Runs one scheduler on the repository from a fresh pod, with no clone left behind"""
+        subprocess.run([ "rm", "-rf", os.path.join(self.git_helper, "proj") ], check=True)
+        scheduler = ss.Scheduler(self.args, 1, ss.ScanState(self.state_path), { "version": "v1", "properties_hash": "h" })
+        job = ss.ScanJob(self.remote)
+        scheduler.run([ job ])
+        return job, os.path.isdir(os.path.join(self.git_helper, "proj"))
+
+    def test_unchanged_remote_is_not_cloned(self):
+        job, cloned = self.run_once()
+        self.assertEqual((job.status, job.reason, cloned), ("ok", "not scanned before", True))
+        job, cloned = self.run_once()
+        self.assertEqual((job.status, cloned), ("unchanged", False))
+        self.commit("second")
+        job, cloned = self.run_once()
+        self.assertEqual((job.status, job.reason, cloned), ("ok", "new commits", True))
+
+
+class GitHTTPHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the repositories under server.root with git http-backend, to clients sending the
+    credentials in server.credentials"""
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        expected = "Basic " + base64.b64encode(self.server.credentials.encode()).decode()
+        if self.headers.get("Authorization") != expected:
+            self.send_response(401)
+            self.send_header("WWW-Authenticate", 'Basic realm="git"')
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        path, _, query = self.path.partition("?")
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        env = dict(os.environ, GIT_PROJECT_ROOT=self.server.root, GIT_HTTP_EXPORT_ALL="1", PATH_INFO=path,
+                   QUERY_STRING=query, REQUEST_METHOD=self.command, CONTENT_LENGTH=str(len(body)),
+                   CONTENT_TYPE=self.headers.get("Content-Type", ""), GIT_PROTOCOL=self.headers.get("Git-Protocol", ""),
+                   HTTP_CONTENT_ENCODING=self.headers.get("Content-Encoding", ""))
+        output = subprocess.run([ "git", "http-backend" ], input=body, env=env, capture_output=True).stdout
+        head, _, payload = output.partition(b"\r\n\r\n")
+        headers = [ line.split(": ", 1) for line in head.decode().split("\r\n") if line ]
+        status = [ int(value.split()[0]) for name, value in headers if name.lower() == "status" ]
+        self.send_response(status[0] if status else 200)
+        for name, value in headers:
+            if name.lower() != "status":
+                self.send_header(name, value)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_POST = do_GET
+
+
+class AuthenticatedRemoteTest(unittest.TestCase):
+    """Scans two repositories on an HTTP remote that needs the credentials fsm clone puts in the
+    URL, which the state file does not keep"""
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        root = os.path.join(self.tmp.name, "remote")
+        for name in ("first", "second"):
+            git("init", "-q", os.path.join(root, name))
+            git("-C", os.path.join(root, name), "-c", "user.name=test", "-c", "user.email=test@example.com",
+                "commit", "-q", "--allow-empty", "-m", "first")
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), GitHTTPHandler)
+        self.server.root = root
+        self.server.credentials = "scanner:s3cret"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.git_helper = os.path.join(self.tmp.name, "git-helper")
+        os.makedirs(self.git_helper)
+        url = f"http://{self.server.credentials}@127.0.0.1:{self.server.server_port}"
+        fsm = os.path.join(self.tmp.name, "fsm")
+        with open(fsm, "wt") as f:
+            f.write(f'#!/bin/sh\nexec git clone -q "{url}/$(basename "$2")" "{self.git_helper}/$(basename "$2")"\n')
+        os.chmod(fsm, 0o755)
+        self.args = argparse.Namespace(clone_jobs=1, scan_jobs=1, scan_memory=1024, window=None,
+                                       clone_timeout=60, scan_timeout=60, force=False, log_dir=self.tmp.name,
+                                       git_helper=self.git_helper, sonar_scanner="true", fsm=fsm)
+        self.state_path = os.path.join(self.tmp.name, "state", "scan-state.json")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmp.cleanup()
+
+    def run_once(self):
+        """- Runs one scheduler on both repositories from a fresh pod, returns their status and
+        whether they were cloned"""
+        for name in ("first", "second"):
+            subprocess.run([ "rm", "-rf", os.path.join(self.git_helper, name) ], check=True)
+        scheduler = ss.Scheduler(self.args, 1, ss.ScanState(self.state_path), { "version": "v1", "properties_hash": "h" })
+        jobs = [ ss.ScanJob("/repos/first"), ss.ScanJob("/repos/second") ]
+        scheduler.run(jobs)
+        return [ (job.status, os.path.isdir(os.path.join(self.git_helper, job.projdir))) for job in jobs ]
+
+    def test_remote_needing_credentials_is_not_cloned(self):
+        self.assertEqual(self.run_once(), [ ("ok", True), ("ok", True) ])
+        with open(self.state_path) as f:
+            self.assertNotIn("s3cret", f.read())
+        # the first clone of the run gives the credentials for the second remote on the host
+        self.assertEqual(self.run_once(), [ ("unchanged", True), ("unchanged", False) ])
+
+
+def git(*args):
+    subprocess.run([ "git", *args ], check=True, capture_output=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,19 @@
 from http.server import HTTPServer, BaseHTTPRequestHandler
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import argparse
+import base64
+import hashlib
+import json
+import os
+import queue
+import selectors
+import signal
+import socket
 import ssl
+import sys
+import threading
+import time
 
 
 def certIsValid(cert):
@@ -14,63 +28,727 @@ def certIsValid(cert):
         return False
     return True
 
+class TLSContext:
+    """Server side of the mTLS connections.  One SSLContext serves every connection, so the
+    session tickets it issues let repeat clients resume instead of doing a full handshake.  A
+    client certificate is checked with certIsValid once per fingerprint, and the context is
+    rebuilt when the certificate files change"""
+    def __init__(self, server_name : str="mtls-server.domain.com"):
+        self.files = (*certpair(server_name), capath())
+        self.lock = threading.Lock()
+        self.stats = { "handshakes": 0, "resumed": 0, "failed": 0, "rejected": 0,
+                       "verify_cache_hits": 0, "reloads": 0 }
+        self.context = None
+        self.stamp = None
+        self.verified = {}
+        self.reload()
+
+    def file_stamp(self):
+        return tuple((st.st_mtime_ns, st.st_size) for st in map(os.stat, self.files))
+
+    def reload(self):
+        """- Builds a new context from the certificate files, the connections already open keep
+        the old one"""
+        stamp = self.file_stamp()
+        crt, key, ca = self.files
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+        context.load_cert_chain(crt, key)
+        context.load_verify_locations(ca)
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.options &= ~ssl.OP_NO_TICKET
+        with self.lock:
+            if self.context is not None:
+                self.stats["reloads"] += 1
+            self.context = context
+            self.stamp = stamp
+            self.verified.clear()
+
+    def refresh(self):
+        """- Reloads the certificates if their files changed, a failed reload keeps the current
+        context"""
+        try:
+            if self.file_stamp() != self.stamp:
+                self.reload()
+                print("certificates reloaded")
+        except (OSError, ssl.SSLError) as e:
+            print(f"certificate reload failed: {e}")
+
+    def wrap(self, sock):
+        """- Runs the handshake of an accepted connection and checks the client certificate
+        Returns:
+            :SSLSocket: the TLS connection, None if the handshake failed or the client was refused
+        """
+        try:
+            conn = self.context.wrap_socket(sock, server_side=True)
+        except OSError:
+            with self.lock:
+                self.stats["failed"] += 1
+            return None
+        fingerprint = hashlib.sha256(conn.getpeercert(binary_form=True)).digest()
+        with self.lock:
+            self.stats["handshakes"] += 1
+            if conn.session_reused:
+                self.stats["resumed"] += 1
+            valid = self.verified.get(fingerprint)
+            if valid is not None:
+                self.stats["verify_cache_hits"] += 1
+        if valid is None:
+            try:
+                valid = certIsValid(conn.getpeercert())
+            except Exception:
+                # no subjectAltName, or an issuer without a commonName where it is expected
+                valid = False
+            with self.lock:
+                if len(self.verified) >= 4096:
+                    self.verified.clear()
+                self.verified[fingerprint] = valid
+        if not valid:
+            with self.lock:
+                self.stats["rejected"] += 1
+            conn.close()
+            return None
+        return conn
+
+    def report(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats["resumption_rate"] = round(stats["resumed"] / stats["handshakes"], 3) if stats["handshakes"] else 0.0
+        return stats
+
+
+class Metrics:
+    """Counters, gauges and latency histograms by label set, rendered in the Prometheus text
+    format.  Values owned by other objects are read at render time through the collectors"""
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, prefix : str, descriptions : dict):
+        self.prefix = prefix
+        self.descriptions = descriptions
+        self.lock = threading.Lock()
+        self.values = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def add(self, name : str, labels : tuple=(), value : float=1):
+        """- Adds to a counter or gauge, labels are (name, value) pairs"""
+        with self.lock:
+            self.values[name, labels] = self.values.get((name, labels), 0) + value
+
+    def observe(self, name : str, labels : tuple, seconds : float):
+        """- Records a duration in a histogram"""
+        with self.lock:
+            h = self.histograms.get((name, labels))
+            if h is None:
+                # a count per bucket and one past the last bound, then the sum and the count
+                h = self.histograms[name, labels] = [0] * (len(self.buckets) + 3)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    h[i] += 1
+                    break
+            else:
+                h[len(self.buckets)] += 1
+            h[-2] += seconds
+            h[-1] += 1
+
+    def time(self, name : str, labels : tuple=()):
+        """- Returns a context manager recording the duration of its block in a histogram"""
+        metrics = self
+        class Timer:
+            def __enter__(self):
+                self.start = time.perf_counter()
+            def __exit__(self, *exc):
+                metrics.observe(name, labels, time.perf_counter() - self.start)
+        return Timer()
+
+    def render(self):
+        """- Returns every metric in the Prometheus text exposition format"""
+        with self.lock:
+            values = dict(self.values)
+            histograms = { k: list(h) for k, h in self.histograms.items() }
+        for collect in self.collectors:
+            for name, labels, value in collect():
+                values[name, labels] = value
+        lines = []
+        for name, (kind, description) in self.descriptions.items():
+            full = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full} {description}")
+            lines.append(f"# TYPE {full} {kind}")
+            if kind == "histogram":
+                for (n, labels), h in sorted(histograms.items()):
+                    if n != name:
+                        continue
+                    total = 0
+                    for bound, count in zip(self.buckets + ("+Inf",), h):
+                        total += count
+                        lines.append(f"{full}_bucket{format_labels(labels + (('le', bound),))} {total}")
+                    lines.append(f"{full}_sum{format_labels(labels)} {h[-2]}")
+                    lines.append(f"{full}_count{format_labels(labels)} {h[-1]}")
+            else:
+                for (n, labels), value in sorted(values.items()):
+                    if n == name:
+                        lines.append(f"{full}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+
+
+class AccessLog:
+    """Access log written by a background thread, a request only queues its line.  Lines are
+    dropped and counted when the writer falls behind by 'maxsize' lines"""
+    def __init__(self, stream, maxsize : int=10000):
+        self.stream = stream
+        self.lines = queue.Queue(maxsize)
+        self.dropped = 0
+        self.writer = threading.Thread(target=self.write, name="secret-server-log", daemon=True)
+        self.writer.start()
+
+    def log(self, line : str):
+        try:
+            self.lines.put_nowait(line)
+        except queue.Full:
+            self.dropped += 1
+
+    def write(self):
+        while True:
+            batch = [ self.lines.get() ]
+            try:
+                while len(batch) < 1000:
+                    batch.append(self.lines.get_nowait())
+            except queue.Empty:
+                pass
+            done = None in batch
+            self.stream.write("".join(line + "\n" for line in batch if line is not None))
+            self.stream.flush()
+            if done:
+                return
+
+    def close(self):
+        """- Writes the queued lines and stops the writer"""
+        self.lines.put(None)
+        self.writer.join()
+
+
+class ExpiringCache:
+    """Values by key, each with its own expiry, bounded by LRU eviction.  Concurrent misses on
+    a key share a single fetch, and an entry past its refresh point is refetched in the
+    background while the cached value is still served"""
+    def __init__(self, maxsize : int=1024, refresh : float=0.8):
+        self.maxsize = maxsize
+        self.refresh = refresh
+        self.entries = OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+        self.stats = { "hit": 0, "refresh": 0, "shared": 0, "miss": 0, "evicted": 0 }
+
+    def get(self, key, fetch):
+        """- Returns the cached value of a key, fetching it on a miss
+        Args:
+            key :Hashable: The cache key
+            fetch :Callable: Returns (value, ttl) for the key, a value of None or a ttl <= 0
+                is returned to the caller but not cached
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires, refresh, value = entry
+                if now < expires:
+                    self.entries.move_to_end(key)
+                    self.stats["hit"] += 1
+                    if now >= refresh and key not in self.inflight:
+                        self.stats["refresh"] += 1
+                        future = self.inflight[key] = Future()
+                        threading.Thread(target=self.load, args=(key, fetch, future),
+                                         name="secret-server-refresh", daemon=True).start()
+                    return value
+                del self.entries[key]
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = Future()
+            self.stats["miss" if owner else "shared"] += 1
+        if owner:
+            self.load(key, fetch, future)
+        return future.result()
+
+    def load(self, key, fetch, future):
+        """- Runs the fetch of a key and hands the result to every caller waiting for it"""
+        try:
+            value, ttl = fetch()
+        except Exception as e:
+            with self.lock:
+                if self.inflight.get(key) is future:
+                    del self.inflight[key]
+            future.set_exception(e)
+            print(f"fetch {key} failed: {e}")
+            return
+        now = time.monotonic()
+        with self.lock:
+            # an invalidation during the fetch drops the key from inflight, the result is then
+            # handed to the waiting callers but not cached
+            if self.inflight.get(key) is future:
+                del self.inflight[key]
+                if value is not None and ttl > 0:
+                    self.entries[key] = (now + ttl, now + ttl * self.refresh, value)
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.maxsize:
+                        self.entries.popitem(last=False)
+                        self.stats["evicted"] += 1
+        future.set_result(value)
+
+    def report(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries), inflight=len(self.inflight))
+
+    def invalidate(self, key=None):
+        """- Drops one key, or every key if None, so the next request fetches it again"""
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+                self.inflight.clear()
+            else:
+                self.entries.pop(key, None)
+                self.inflight.pop(key, None)
+
+
+cache = ExpiringCache()
+metrics = Metrics("secret_server", {
+    "requests_total": ("counter", "HTTP requests by method, route and status"),
+    "request_duration_seconds": ("histogram", "HTTP request latency by route"),
+    "requests_in_flight": ("gauge", "HTTP requests being served"),
+    "idle_connections": ("gauge", "Keep-alive connections waiting for their next request"),
+    "backend_duration_seconds": ("histogram", "Latency of the keyring and Foundry calls"),
+    "backend_errors_total": ("counter", "Failed keyring and Foundry calls"),
+    "cache_requests_total": ("counter", "Cache lookups by result, a shared miss waited for another caller's fetch"),
+    "cache_refreshes_total": ("counter", "Entries refreshed in the background before they expired"),
+    "cache_evictions_total": ("counter", "Cache entries evicted to stay within --cache-size"),
+    "cache_entries": ("gauge", "Cached secrets and tokens"),
+    "tls_handshakes_total": ("counter", "Completed TLS handshakes"),
+    "tls_resumed_handshakes_total": ("counter", "TLS handshakes resuming an earlier session"),
+    "tls_failed_handshakes_total": ("counter", "TLS handshakes that failed"),
+    "tls_rejected_clients_total": ("counter", "Client certificates refused by certIsValid"),
+    "access_log_dropped_total": ("counter", "Access log lines dropped because the writer fell behind"),
+})
+access_log = None
+
+def collect_cache():
+    stats = cache.report()
+    for result in ("hit", "shared", "miss"):
+        yield "cache_requests_total", (("result", result),), stats[result]
+    yield "cache_refreshes_total", (), stats["refresh"]
+    yield "cache_evictions_total", (), stats["evicted"]
+    yield "cache_entries", (), stats["entries"]
+    yield "access_log_dropped_total", (), access_log.dropped if access_log else 0
+
+metrics.collectors.append(collect_cache)
+
+def request_route(path):
+    """- Returns the route label of a request path, every unknown path shares one label"""
+    for route in ("/secret/", "/foundry-token"):
+        if path.startswith(route):
+            return route.rstrip("/")
+    return path if path in ("/secrets", "/metrics", "/tls-stats", "/cache") else "other"
+secret_ttl = 300
+token_ttl = 3600
+token_margin = 60
+# keyring lookups of the batch requests, separate from the connection workers so a batch
+# never waits for a worker held by another batch
+lookups = ThreadPoolExecutor(max_workers=8, thread_name_prefix="secret-server-lookup")
+max_batch = 256
+# bytes of a batch request, service and user names have no length limit so this does not
+# depend on max_batch
+max_body = 1 << 20
+
+
+def backend_call(backend, fn, *args):
+    """- Calls a secret backend, recording its latency and errors"""
+    try:
+        with metrics.time("backend_duration_seconds", (("backend", backend),)):
+            return fn(*args)
+    except Exception:
+        metrics.add("backend_errors_total", (("backend", backend),))
+        raise
+
+def fetch_secret(service, user):
+    import keyring
+    return backend_call("keyring", keyring.get_password, service, user), secret_ttl
+
+def get_secret(service, user):
+    return cache.get(("secret", service, user), lambda: fetch_secret(service, user))
+
+def get_secrets(pairs):
+    """- Looks up (service, user) pairs concurrently
+    Args:
+        pairs :list: The [service, user] pairs to look up
+    Returns:
+        :dict: the secrets found by "service/user", the names of the missing secrets and the
+            error message of every lookup that failed
+    """
+    futures = { f"{service}/{user}": lookups.submit(get_secret, service, user) for service, user in pairs }
+    result = { "secrets": {}, "missing": [], "errors": {} }
+    for name, future in futures.items():
+        try:
+            secret = future.result()
+        except Exception as e:
+            result["errors"][name] = str(e)
+            continue
+        if secret is None:
+            result["missing"].append(name)
+        else:
+            result["secrets"][name] = secret
+    return result
+
+def token_expiry(token):
+    """- Returns the 'exp' claim of a JWT as a wall clock time, None if the token is not a JWT"""
+    parts = token.split(".")
+    if len(parts) != 3:
+        return None
+    try:
+        payload = parts[1] + "=" * (-len(parts[1]) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+def fetch_foundry_token():
+    import foundrysmith as fsm
+    token = backend_call("foundry", fsm.FoundryAPI).auth_token
+    expires = token_expiry(token)
+    ttl = token_ttl if expires is None else expires - time.time()
+    # the cached token is dropped 'token_margin' seconds before it expires, so a caller never
+    # gets a token that expires while it is being used
+    return token, ttl - token_margin
+
+
 class MyHTTPRequestHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps the connection open for the next request, which it waits for in the
+    # server's selector, see PooledHTTPServer.  A client stalling in the middle of a request
+    # is dropped after 'timeout' seconds
+    protocol_version = "HTTP/1.1"
+    timeout = 5
+    # headers and body are written separately, without TCP_NODELAY the second write of a
+    # keep-alive response waits for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        # serves the requests that already arrived, then returns the connection to the server
+        self.handle_one_request()
+        while not self.close_connection and self.input_pending():
+            self.handle_one_request()
+
+    def input_pending(self):
+        """- Returns true if the next request is already buffered or readable"""
+        self.connection.settimeout(0)
+        try:
+            return len(self.rfile.peek(1)) > 0
+        except OSError:
+            # SSLWantReadError, no complete TLS record yet
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def handle_one_request(self):
+        self.started = None
+        self.status = None
+        try:
+            super().handle_one_request()
+        finally:
+            if self.started is not None:
+                route = request_route(getattr(self, "path", ""))
+                metrics.add("requests_in_flight", value=-1)
+                metrics.add("requests_total", (("method", self.command or "-"), ("route", route),
+                                               ("status", str(self.status or "error"))))
+                metrics.observe("request_duration_seconds", (("route", route),), time.perf_counter() - self.started)
+
+    def parse_request(self):
+        # called once the request line is read, an idle keep-alive connection is not timed
+        self.started = time.perf_counter()
+        metrics.add("requests_in_flight")
+        return super().parse_request()
+
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
+
+    def log_message(self, format, *args):
+        if access_log is None:
+            return super().log_message(format, *args)
+        access_log.log(f"{self.address_string()} - - [{self.log_date_time_string()}] {format % args}")
+
+    def send(self, status, content_type, body):
+        data = bytes(body, 'UTF-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        if self.server.stopping:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(data)
+
     def do_GET(self):
-        print(f"GET {self.path}")
         if self.path.startswith("/secret/"):
-            import keyring
             args = self.path.split("/")
             secret = None
             if len(args) == 4:
                 service = args[2]
                 user = args[3]
-                secret = keyring.get_password(service, user)
+                try:
+                    secret = get_secret(service, user)
+                except Exception as e:
+                    self.send(502, 'text/plain', f'Secret backend error: {e}')
+                    return
             if secret is None:
-                self.send_response(404)
-                self.send_header('Content-Type', 'text/plain')
-                self.end_headers()
-                self.wfile.write(bytes(f'Unknown secret {service} {user}', 'UTF-8'))
+                self.send(404, 'text/plain', f'Unknown secret {"/".join(args[2:])}')
             else:
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(bytes(secret, 'UTF-8'))
+                self.send(200, 'application/json', secret)
         elif self.path.startswith("/foundry-token"):
-            import foundrysmith as fsm
-            import json
-            api = fsm.FoundryAPI()
-            token_data = { "token": api.auth_token }
-            self.send_response(200)
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-            print("send> '{json.dumps(token_data)}")
-            self.wfile.write(bytes(json.dumps(token_data), 'UTF-8'))
+            try:
+                token_data = { "token": cache.get(("foundry-token",), fetch_foundry_token) }
+            except Exception as e:
+                self.send(502, 'text/plain', f'Foundry error: {e}')
+                return
+            self.send(200, 'application/json', json.dumps(token_data))
+        elif self.path == "/metrics":
+            self.send(200, 'text/plain; version=0.0.4', metrics.render())
+        elif self.path == "/tls-stats" and self.server.tls:
+            self.send(200, 'application/json', json.dumps(self.server.tls.report()))
+        else:
+            self.send(404, 'text/plain', f'Unrecognized request {self.path}')
+
+    def do_POST(self):
+        if self.path != "/secrets":
+            self.send(404, 'text/plain', f'Unrecognized request {self.path}')
+            return
+        length = None
+        try:
+            header = self.headers.get('Content-Length') or '0'
+            if not header.isdigit():
+                raise ValueError(f"Content-Length {header!r} is not a byte count")
+            length = int(header)
+            if length > max_body:
+                self.close_connection = True
+                self.send(413, 'text/plain', 'Request too large')
+                return
+            pairs = json.loads(self.rfile.read(length))
+            if not isinstance(pairs, list) or len(pairs) > max_batch:
+                raise ValueError(f"expected a list of at most {max_batch} [service, user] pairs")
+            for pair in pairs:
+                if not isinstance(pair, list) or len(pair) != 2 or not all(isinstance(v, str) for v in pair):
+                    raise ValueError(f"expected a [service, user] pair, got {json.dumps(pair)}")
+        except ValueError as e:
+            if length is None:
+                # the body was not read, so the connection cannot carry another request
+                self.close_connection = True
+            self.send(400, 'text/plain', f'Invalid request: {e}')
+            return
+        self.send(200, 'application/json', json.dumps(get_secrets(pairs)))
+
+    def do_DELETE(self):
+        args = self.path.split("/")
+        if self.path == "/cache":
+            cache.invalidate()
+        elif self.path.startswith("/secret/") and len(args) == 4:
+            cache.invalidate(("secret", args[2], args[3]))
+        elif self.path == "/foundry-token":
+            cache.invalidate(("foundry-token",))
         else:
-            # cert = self.connection.getpeercert()
-            # if cert is None or not certIsValid(cert):
-            #     self.send_response(403)
-            #     self.end_headers()
-            #     return
+            self.send(404, 'text/plain', f'Unrecognized request {self.path}')
+            return
+        self.send(200, 'text/plain', 'invalidated')
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer handling each request on a bounded pool of worker threads, so a request
+    blocked in a slow backend does not hold up the others.  Between requests a keep-alive
+    connection waits in a selector instead of on a worker, so the pool bounds the requests in
+    progress rather than the open connections"""
+    # the default backlog of 5 drops the connections of a burst of clients, which then
+    # retry after a second
+    request_queue_size = 128
+    # seconds a keep-alive connection may wait for its next request
+    idle_timeout = 60
+
+    def __init__(self, server_address, RequestHandlerClass, workers=16, tls=None):
+        super().__init__(server_address, RequestHandlerClass)
+        self.tls = tls
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="secret-server")
+        self.connections = set()
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.idle = selectors.DefaultSelector()
+        self.parked = queue.SimpleQueue()
+        self.wakeup, self.wakeup_sender = socket.socketpair()
+        self.idle.register(self.wakeup, selectors.EVENT_READ)
+        self.watcher = threading.Thread(target=self.watch_idle, name="secret-server-idle")
+        self.watcher.start()
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections.add(request)
+        self.pool.submit(self.process_request_thread, request, client_address, self.tls is not None)
+
+    def process_request_thread(self, request, client_address, handshake=False):
+        keep = False
+        try:
+            if handshake:
+                # the handshake runs on the worker, a slow client does not hold up accept
+                request.settimeout(self.RequestHandlerClass.timeout)
+                conn = self.tls.wrap(request)
+                if conn is None:
+                    return
+                with self.lock:
+                    self.connections.discard(request)
+                    self.connections.add(conn)
+                request = conn
+            keep = not self.RequestHandlerClass(request, client_address, self).close_connection
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            if keep:
+                self.park(request, client_address)
+            else:
+                self.drop(request)
+
+    def park(self, request, client_address):
+        """- Hands an idle keep-alive connection to watch_idle"""
+        with self.lock:
+            if not self.stopping:
+                self.parked.put((request, client_address))
+                self.wakeup_sender.send(b"\0")
+                return
+        self.drop(request)
 
-            self.send_response(404)
-            self.send_header('Content-Type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(bytes('Unrecognized request {self.path}', 'UTF-8'))
+    def drop(self, request):
+        with self.lock:
+            self.connections.discard(request)
+        self.shutdown_request(request)
 
+    def watch_idle(self):
+        """- Submits each idle keep-alive connection to the pool when its next request arrives,
+        and closes it after 'idle_timeout' seconds.  Runs until stop"""
+        expires = {}
+        sweep = time.monotonic() + 1
+        while not self.stopping:
+            for key, _ in self.idle.select(timeout=1):
+                if key.fileobj is self.wakeup:
+                    self.wakeup.recv(4096)
+                    continue
+                self.idle.unregister(key.fileobj)
+                del expires[key.fileobj]
+                metrics.add("idle_connections", value=-1)
+                self.pool.submit(self.process_request_thread, key.fileobj, key.data)
+            now = time.monotonic()
+            while not self.parked.empty():
+                request, client_address = self.parked.get()
+                self.idle.register(request, selectors.EVENT_READ, client_address)
+                expires[request] = now + self.idle_timeout
+                metrics.add("idle_connections")
+            if now >= sweep:
+                sweep = now + 1
+                for request in [ r for r, t in expires.items() if t <= now ]:
+                    self.idle.unregister(request)
+                    del expires[request]
+                    metrics.add("idle_connections", value=-1)
+                    self.drop(request)
+        while not self.parked.empty():
+            self.drop(self.parked.get()[0])
+        for request in expires:
+            self.idle.unregister(request)
+            metrics.add("idle_connections", value=-1)
+            self.drop(request)
+
+    def stop(self):
+        """Stops accepting connections, lets the requests in progress finish and closes the
+        idle keep-alive connections.  Call it from another thread than serve_forever"""
+        with self.lock:
+            self.stopping = True
+        self.shutdown()
+        self.wakeup_sender.send(b"\0")
+        self.watcher.join()
+        with self.lock:
+            for request in self.connections:
+                try:
+                    # a request still being read sees the end of the stream
+                    request.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+        self.pool.shutdown(wait=True)
+        self.server_close()
+        self.idle.close()
+        self.wakeup.close()
+        self.wakeup_sender.close()
+
+
+certdir = "./openssl"
 
 def certpath(name, ext):
-    return f"./openssl/{name}/{name}.{ext}"
+    return f"{certdir}/{name}/{name}.{ext}"
+
+def capath():
+    return f"{certdir}/certs/myCA.pem"
 
 def certpair(name):
     return (certpath(name, "crt"), certpath(name, "key"))
 
-httpd = HTTPServer(('localhost', 4443), MyHTTPRequestHandler)
 
-#httpd.socket = ssl.wrap_socket (httpd.socket,
-#        keyfile=certpath("mtls-server.domain.com", "key"),
-#        certfile=certpath("mtls-server.domain.com", "crt"),
-#        ca_certs="./openssl/certs/myCA.pem", server_side=True, cert_reqs=ssl.CERT_REQUIRED)
+def collect_tls(tls):
+    stats = tls.report()
+    yield "tls_handshakes_total", (), stats["handshakes"]
+    yield "tls_resumed_handshakes_total", (), stats["resumed"]
+    yield "tls_failed_handshakes_total", (), stats["failed"]
+    yield "tls_rejected_clients_total", (), stats["rejected"]
+
+
+def main():
+    global secret_ttl, token_ttl, token_margin, certdir, access_log
+    parser = argparse.ArgumentParser(description="Serves secrets and foundry tokens to local jobs")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=4443)
+    parser.add_argument("--workers", type=int, default=16, help="requests served at the same time")
+    parser.add_argument("--cache-size", type=int, default=1024, help="cached secrets and tokens")
+    parser.add_argument("--secret-ttl", type=float, default=secret_ttl, help="seconds a secret is cached")
+    parser.add_argument("--token-ttl", type=float, default=token_ttl,
+                        help="lifetime of a foundry token that does not carry its expiry")
+    parser.add_argument("--token-margin", type=float, default=token_margin,
+                        help="seconds before its expiry a foundry token is no longer served")
+    parser.add_argument("--certs", default=certdir, help="certificate directory, see make-test-certs.sh")
+    parser.add_argument("--access-log", help="access log file, stderr if not given")
+    parser.add_argument("--no-tls", action="store_true", help="serve plain HTTP without client certificates")
+    args = parser.parse_args()
+    certdir = args.certs
+    cache.maxsize = args.cache_size
+    secret_ttl = args.secret_ttl
+    token_ttl = args.token_ttl
+    token_margin = args.token_margin
+
+    access_log = AccessLog(open(args.access_log, "at") if args.access_log else sys.stderr)
+    tls = None if args.no_tls else TLSContext()
+    if tls:
+        metrics.collectors.append(lambda: collect_tls(tls))
+    httpd = PooledHTTPServer((args.host, args.port), MyHTTPRequestHandler, workers=args.workers, tls=tls)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    server = threading.Thread(target=httpd.serve_forever, name="secret-server-accept")
+    server.start()
+    print(f"listening at {args.host}:{args.port}")
+    while not stop.wait(1):
+        if tls:
+            tls.refresh()
+    print("stopping")
+    httpd.stop()
+    server.join()
+    if tls:
+        print(f"tls {json.dumps(tls.report())}")
+    access_log.close()
 
 
-print("listening at localhost:4443")
-httpd.serve_forever()
+if __name__ == "__main__":
+    main()